@@ -0,0 +1,318 @@
+# Run the display against a local stand-in for the WMATA API and time it
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import argparse
+import ctypes
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import percentile
+
+PREDICTION_PREFIX = "/StationPrediction.svc/json/GetPrediction/"
+INCIDENTS_PATH = "/Incidents.svc/json/Incidents"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the display on a virtual matrix against a local WMATA stand-in and report how it performs.")
+    parser.add_argument("font_file")
+    parser.add_argument("lines_file")
+    parser.add_argument("stations_file")
+    parser.add_argument("--station", default="A01", help="station code(s) to show, same format as run.sh")
+    parser.add_argument("--direction", default="1", help="direction code(s) to show, same format as run.sh")
+    parser.add_argument("--duration", type=float, default=120, help="seconds to run for")
+    parser.add_argument("--predictions", help="JSON file with a GetPrediction response, or a list of them to replay in order")
+    parser.add_argument("--incidents", help="JSON file with an Incidents response, or a list of them to replay in order")
+    parser.add_argument("--incident-interval", type=float, default=60, help="seconds between incident checks")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stand-in waits before answering")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds, picked at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of requests answered with broken JSON")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the latency, errors and malformed responses")
+    parser.add_argument("--log", default=os.devnull, help="where the display's log goes")
+    parser.add_argument("--output", help="also write the results to this file as JSON")
+    return parser.parse_args()
+
+
+def load_payloads(path):
+    if path == None:
+        return None
+    with open(path) as f:
+        payloads = json.load(f)
+    if not isinstance(payloads, list):
+        payloads = [payloads]
+    return payloads
+
+
+def synthetic_predictions(station_codes, index):
+    # Trains on both platforms of every station asked for, a
+    # minute closer on each request so every answer is different
+    trains = []
+    for code in station_codes:
+        for group in ("1", "2"):
+            for offset in (0, 6, 13):
+                minutes = (12 - index + offset) % 20
+                trains.append({
+                    "Car": "8" if offset == 0 else "6",
+                    "Destination": "Terminal {}".format(group),
+                    "DestinationName": "Terminal {}".format(group),
+                    "Group": group,
+                    "Line": "RD",
+                    "LocationCode": code,
+                    "Min": "ARR" if minutes == 0 else str(minutes)
+                })
+    return {"Trains": trains}
+
+
+class StandIn:
+    # Answers GetPrediction and Incidents the way WMATA would, slowed
+    # down and broken on purpose. Each endpoint has its own seeded
+    # random numbers so the n-th request to it always gets the same
+    # treatment no matter how the two endpoints interleave.
+    def __init__(self, args):
+        self.args = args
+        self.predictions = load_payloads(args.predictions)
+        self.incidents = load_payloads(args.incidents) or [{"Incidents": []}]
+        self._lock = threading.Lock()
+        self._random = {
+            "GetPrediction": random.Random(args.seed),
+            "Incidents": random.Random(args.seed + 1)
+        }
+        self.counts = {"GetPrediction": 0, "Incidents": 0}
+        self.errors = {"GetPrediction": 0, "Incidents": 0}
+        self.malformed = {"GetPrediction": 0, "Incidents": 0}
+        # monotonic time each good GetPrediction answer went out, and whether it changed
+        self.answers = []
+        self._last_body = None
+
+    def respond(self, endpoint, path):
+        with self._lock:
+            index = self.counts[endpoint]
+            self.counts[endpoint] += 1
+            rng = self._random[endpoint]
+            delay = self.args.latency + rng.uniform(0, self.args.jitter)
+            roll = rng.random()
+            if roll < self.args.error_rate:
+                self.errors[endpoint] += 1
+            elif roll < self.args.error_rate + self.args.malformed_rate:
+                self.malformed[endpoint] += 1
+
+        if roll < self.args.error_rate:
+            return delay, 500, b'{"Message": "stand-in error"}', False
+
+        if endpoint == "GetPrediction":
+            if self.predictions == None:
+                payload = synthetic_predictions(path[len(PREDICTION_PREFIX):].split(","), index)
+            else:
+                payload = self.predictions[index % len(self.predictions)]
+        else:
+            payload = self.incidents[index % len(self.incidents)]
+        body = json.dumps(payload).encode()
+
+        if roll < self.args.error_rate + self.args.malformed_rate:
+            return delay, 200, body[:len(body) // 2], False
+        return delay, 200, body, True
+
+    def answered(self, body):
+        with self._lock:
+            self.answers.append((time.monotonic(), body != self._last_body))
+            self._last_body = body
+
+
+def make_handler(stand_in):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path.startswith(PREDICTION_PREFIX):
+                endpoint = "GetPrediction"
+            elif self.path == INCIDENTS_PATH:
+                endpoint = "Incidents"
+            else:
+                self.send_error(404)
+                return
+
+            delay, status, body, intact = stand_in.respond(endpoint, self.path)
+            time.sleep(delay)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            self.wfile.flush()
+            if endpoint == "GetPrediction" and intact:
+                stand_in.answered(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def load_display():
+    # The main script has a dash in its name so it can't just be imported
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpi-metro-display.py")
+    spec = importlib.util.spec_from_file_location("metro_display", path)
+    display = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(display)
+    return display
+
+
+def run_child(display, control, args, conn):
+    # Runs in the forked display process. The display runs on a
+    # thread while this one waits out the benchmark and reports back.
+    log = open(args.log, "a")
+    sys.stderr = log
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    # Whatever the parent logged to before the fork goes to the terminal
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.StreamHandler(log))
+    random.seed(args.seed)
+
+    # Note when a board actually reached the panel
+    board_frames = []
+
+    class TimedRenderer(display.FrameRenderer):
+        def update_rows(self, rows, draw_row):
+            drawn = super().update_rows(rows, draw_row)
+            if drawn:
+                board_frames.append(time.monotonic())
+            return drawn
+
+    display.FrameRenderer = TimedRenderer
+    display.INCIDENT_CHECK_SECONDS = args.incident_interval
+
+    started = time.monotonic()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    thread = threading.Thread(target=display.run_display, args=("benchmark", control, args.font_file), daemon=True)
+    thread.start()
+    time.sleep(args.duration)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    conn.send({
+        "started": started,
+        "boardFrames": list(board_frames),
+        "cpuSeconds": (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime),
+        # ru_maxrss is in kilobytes on Linux
+        "maxRssMB": usage.ru_maxrss / 1024.0
+    })
+    conn.close()
+    log.flush()
+    os._exit(0)
+
+
+def update_latencies(answers, frames):
+    # For each answer that changed the times, how long until the
+    # next board was drawn. Only one prediction request is out at a
+    # time so a frame before the next answer belongs to this one.
+    latencies = []
+    missed = 0
+    frame_index = 0
+    for i, (answered_at, changed) in enumerate(answers):
+        next_answer = answers[i + 1][0] if i + 1 < len(answers) else float("inf")
+        while frame_index < len(frames) and frames[frame_index] < answered_at:
+            frame_index += 1
+        if not changed:
+            continue
+        if frame_index < len(frames) and frames[frame_index] < next_answer:
+            latencies.append(frames[frame_index] - answered_at)
+        else:
+            missed += 1
+    return latencies, missed
+
+
+def main():
+    args = parse_args()
+
+    # Bind first so the display knows where to find the stand-in
+    stand_in = StandIn(args)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(stand_in))
+    server.daemon_threads = True
+    os.environ["WMATA_BASE_URL"] = "http://127.0.0.1:{}".format(server.server_port)
+    os.environ["VIRTUAL_MATRIX"] = "1"
+
+    display = load_display()
+    display.lines_file = multiprocessing.Value(ctypes.c_wchar_p, args.lines_file)
+    display.stations_file = multiprocessing.Value(ctypes.c_wchar_p, args.stations_file)
+    display.registry()
+    control = display.ControlBlock()
+    control.publish(display.parse_targets(args.station, args.direction))
+
+    # Fork before any server threads exist
+    parent_conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.get_context("fork").Process(target=run_child, args=(display, control, args, child_conn))
+    child.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    result = parent_conn.recv()
+    child.join()
+    server.shutdown()
+
+    minutes = args.duration / 60.0
+    latencies, missed = update_latencies(stand_in.answers, result["boardFrames"])
+    latencies.sort()
+    first_frame = [t - result["started"] for t in result["boardFrames"][1:2]]
+
+    report = {
+        "seed": args.seed,
+        "durationSeconds": args.duration,
+        "latencySeconds": args.latency,
+        "errorRate": args.error_rate,
+        "malformedRate": args.malformed_rate,
+        "predictionPollsPerMinute": stand_in.counts["GetPrediction"] / minutes,
+        "incidentPollsPerMinute": stand_in.counts["Incidents"] / minutes,
+        "errorsServed": sum(stand_in.errors.values()),
+        "malformedServed": sum(stand_in.malformed.values()),
+        "boardFrames": len(result["boardFrames"]),
+        "firstTimesSeconds": first_frame[0] if len(first_frame) > 0 else None,
+        "updateLatencyMs": {
+            "count": len(latencies),
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "max": latencies[-1] * 1000 if len(latencies) > 0 else 0.0
+        },
+        "updatesMissed": missed,
+        "cpuSeconds": result["cpuSeconds"],
+        "cpuPercent": 100.0 * result["cpuSeconds"] / args.duration,
+        "maxRssMB": result["maxRssMB"]
+    }
+
+    print("Prediction polls per minute: {:.1f}".format(report["predictionPollsPerMinute"]))
+    print("Incident polls per minute:   {:.1f}".format(report["incidentPollsPerMinute"]))
+    print("Errors / malformed served:   {} / {}".format(report["errorsServed"], report["malformedServed"]))
+    print("Board frames drawn:          {}".format(report["boardFrames"]))
+    print("Update latency (ms):         p50 {p50:.2f}  p90 {p90:.2f}  max {max:.2f}  ({count} updates)".format(**report["updateLatencyMs"]))
+    print("Updates never drawn:         {}".format(missed))
+    print("Display CPU:                 {:.2f}s ({:.1f}%)".format(report["cpuSeconds"], report["cpuPercent"]))
+    print("Display max RSS:             {:.1f} MB".format(report["maxRssMB"]))
+
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
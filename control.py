@@ -0,0 +1,113 @@
+# Shared state between the API process and the display process
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import ctypes
+import json
+import os
+import time
+from multiprocessing import Lock, RawArray, RawValue
+
+# Plenty for a handful of (station, direction, lines) targets
+RECORD_SIZE = 1024
+
+
+class ControlBlock:
+    # The API writes the state it wants (requested) and the display
+    # writes back the state it's actually showing (applied). Each is
+    # one JSON record with a version number, swapped under a lock so
+    # station, direction and lines always change together and a
+    # burst of writes just leaves the latest one for the display.
+    def __init__(self):
+        self._lock = Lock()
+        self._version = RawValue(ctypes.c_ulong, 0)
+        self._requested = RawArray(ctypes.c_char, RECORD_SIZE)
+        self._applied_version = RawValue(ctypes.c_ulong, 0)
+        self._applied = RawArray(ctypes.c_char, RECORD_SIZE)
+        # time.monotonic() is system wide so both processes can use it
+        self._published_at = RawValue(ctypes.c_double, 0)
+        self._change_latency = RawValue(ctypes.c_double, -1)
+
+        # A byte is written here on every publish so the display can
+        # sleep on the file descriptor instead of polling the version
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+
+    def publish(self, targets):
+        record = encode(targets)
+        with self._lock:
+            self._requested.value = record
+            self._version.value += 1
+            self._published_at.value = time.monotonic()
+            version = self._version.value
+
+        try:
+            os.write(self._wake_write, b'!')
+        except BlockingIOError:
+            # Pipe is full, the display already has plenty to wake up for
+            pass
+        return version
+
+    def wake_fd(self):
+        return self._wake_read
+
+    def drain_wake(self):
+        try:
+            while os.read(self._wake_read, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def published_at(self):
+        return self._published_at.value
+
+    def record_change_latency(self, seconds):
+        self._change_latency.value = seconds
+
+    def change_latency(self):
+        # Seconds from the last publish to it being drawn, -1 if unknown
+        return self._change_latency.value
+
+    def version(self):
+        # Lets the display skip wake-ups it has already handled
+        return self._version.value
+
+    def read(self):
+        with self._lock:
+            return self._version.value, decode(self._requested.value)
+
+    def mark_applied(self, version, targets):
+        record = encode(targets)
+        with self._lock:
+            self._applied.value = record
+            self._applied_version.value = version
+
+    def applied(self):
+        with self._lock:
+            if self._applied_version.value == 0:
+                return 0, None
+            return self._applied_version.value, decode(self._applied.value)
+
+
+def encode(targets):
+    record = json.dumps([list(target) for target in targets]).encode()
+    if len(record) >= RECORD_SIZE:
+        raise ValueError("Control record too large: {} bytes".format(len(record)))
+    return record
+
+
+def decode(record):
+    return [tuple(target) for target in json.loads(record.decode())]
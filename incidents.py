@@ -15,11 +15,17 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 import traceback
-from rgbmatrix import RGBMatrix, RGBMatrixOptions, graphics
+from matrix_backend import RGBMatrix, RGBMatrixOptions, graphics
 import time
 import sys
-import requests
+import os
 import logging
+from functools import lru_cache
+from render_resources import get_font, get_color, get_banner_stripes
+from metrics import display_metrics
+from wmata_client import get_client
+
+log = logging.getLogger(__name__)
 
 def init_matrix():
     options = RGBMatrixOptions()
@@ -30,189 +36,277 @@ def init_matrix():
     options.gpio_slowdown = 2
     return RGBMatrix(options = options)
 
-def get_incidents(lines_requested, api_key):
-    messages = []
+# Incidents that haven't changed since we last showed them
+# only get shown again after this many seconds
+INCIDENT_REPLAY_SECONDS = int(os.environ.get("INCIDENT_REPLAY_SECONDS", 300))
+
+
+def fetch_incidents(api_key):
+    start = time.monotonic()
+    incidents = request_incidents(api_key)
+    display_metrics.observe("metro_wmata_request_seconds", time.monotonic() - start, "Incidents")
+    display_metrics.inc("metro_wmata_requests_total", "Incidents")
+    if incidents == None:
+        display_metrics.inc("metro_wmata_failures_total", "Incidents")
+    return incidents
+
+
+def request_incidents(api_key):
     try:
-        headers = {"api_key":api_key, "Accept":"application/json"}
-        resp = requests.get('https://api.wmata.com/Incidents.svc/json/Incidents', headers=headers)
-        logging.info("Attempting to get train data!")
+        resp = get_client(api_key).get_incidents()
         if resp.status_code != 200:
-            logging.error("Error getting train data! Response status code: ", resp.status_code)
-        else:
-            resp_json = resp.json()
-            logging.info("Attemtpting to read JSON")
-
-            for incident in resp_json['Incidents']:
-                logging.info("Incident: {}".format(incident))
-                logging.info("I am looping")
-                # Grab the lines, strip the strings afterward because
-                # if we split on '; ' instead of ';' we miss the single
-                # string case
-                lines_affected = incident['LinesAffected'].split(';')
-                logging.info("Lines: {}".format(lines_requested))
-                logging.info(lines_affected)
-                for index, line in enumerate(lines_affected):
-                    lines_affected[index] = line.strip()
-
-                logging.info(set(lines_requested).intersection(lines_affected))
-                if bool(set(lines_requested).intersection(lines_affected)):
-                    if incident['Description']:
-                        desc = incident['Description'].replace("\n", " ")
-                        messages.append(desc)
-                        logging.info("matched!")
+            log.error("Error getting incidents! Response status code: {}".format(resp.status_code))
+            return None
+        return resp.json()['Incidents']
     except Exception:
         tb = traceback.format_exc()
         traceback.print_exc()
-        logging.error("well that went wrong...")
-        logging.error(tb)
+        log.error("well that went wrong...")
+        log.error(tb)
+        return None
 
-    logging.info(messages)
 
-    return messages
+def get_incidents(lines_requested, api_key):
+    store = IncidentStore(replay_seconds=0)
+    incidents = fetch_incidents(api_key)
+    if incidents != None:
+        store.update(incidents)
+    return store.due_messages(lines_requested, time.monotonic())
+
+
+def parse_lines_affected(lines_affected):
+    # Split on ';' and strip afterward because if we split
+    # on '; ' instead of ';' we miss the single string case
+    lines = []
+    for line in lines_affected.split(';'):
+        line = line.strip()
+        if line != "":
+            lines.append(line)
+    return lines
+
+
+class IncidentStore:
+    def __init__(self, replay_seconds=INCIDENT_REPLAY_SECONDS):
+        self.replay_seconds = replay_seconds
+        # IncidentID -> (DateUpdated, message), kept in feed order
+        self._incidents = {}
+        self._by_line = {}
+        # IncidentID -> (DateUpdated, when it was last shown)
+        self._shown = {}
+
+    def update(self, incidents):
+        current = {}
+        by_line = {}
+        for incident in incidents:
+            incident_id = incident['IncidentID']
+            updated = incident['DateUpdated']
+
+            known = self._incidents.get(incident_id)
+            if known != None and known[0] == updated:
+                message = known[1]
+            else:
+                message = None
+                if incident['Description']:
+                    message = incident['Description'].replace("\n", " ")
+                log.info("New or updated incident {}: {}".format(incident_id, message))
+
+            current[incident_id] = (updated, message)
+            for line in parse_lines_affected(incident['LinesAffected']):
+                by_line.setdefault(line, []).append(incident_id)
+
+        for incident_id in self._incidents:
+            if incident_id not in current:
+                log.info("Incident {} cleared".format(incident_id))
+                self._shown.pop(incident_id, None)
+
+        self._incidents = current
+        self._by_line = by_line
+
+    def due_messages(self, lines_requested, now):
+        ids = set()
+        for line in lines_requested:
+            ids.update(self._by_line.get(line, ()))
+
+        messages = []
+        # Walk the incidents rather than the set to keep the feed's order
+        for incident_id, (updated, message) in self._incidents.items():
+            if incident_id not in ids or message == None:
+                continue
+            shown = self._shown.get(incident_id)
+            if shown == None or shown[0] != updated or now - shown[1] >= self.replay_seconds:
+                messages.append(message)
+                self._shown[incident_id] = (updated, now)
+
+        log.debug("Incidents due for {}: {}".format(lines_requested, len(messages)))
+        return messages
+
 
 def compute_offset(line):
     pxLength = len(line) * 6
     offset = (128 - pxLength) / 2
     return offset
 
-def add_line(line, lines):
-    offset = compute_offset(line)
-    lines.append((line, offset))
+# How long the banner and each page of a message stay up
+PAGE_SECONDS = 5
+LINES_PER_PAGE = 4
+LINE_LENGTH = 21
+LINE_HEIGHT = 8
 
+# Messages whose pages we keep around. Incidents get replayed
+# every few minutes, so this only needs to cover what's active.
+LAYOUT_CACHE_SIZE = 64
 
-def divide_lines(words, lines):
-    line = words[0]
 
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def layout_message(message):
+    # Each page is a tuple of (text, x, y, color name). Pages are
+    # built in one pass over the words and cached, so replaying an
+    # incident that hasn't changed doesn't lay it out again.
+    pages = []
+    page = []
+
+    def add_line(text, color):
+        page.append((text, compute_offset(text), 7 + len(page) * LINE_HEIGHT, color))
+        if len(page) == LINES_PER_PAGE:
+            pages.append(tuple(page))
+            page.clear()
+
+    title_divided = message.split(': ', 1)
+    body = message
+    if len(title_divided) == 2:
+        title, body = title_divided
+        # Shouldn't need to worry about a word
+        # longer than 21 for now since Silver/Blue/Orange
+        # is the max # of metro lines per alert assuming all lines
+        # is all lines
+        if title != '':
+            fill_lines(title.split(' '), "red", add_line)
+
+    words = []
+    for word in body.split(' '):
+        if len(word) <= LINE_LENGTH:
+            words.append(word)
+            continue
+        # Too long for a line, break it into 20 character
+        # pieces with every full piece ending in a hyphen
+        for x in range(0, len(word), 20):
+            piece = word[x : x + 20]
+            words.append(piece + '-' if len(piece) >= 20 else piece)
+    fill_lines(words, "yellow", add_line)
+
+    if len(page) > 0:
+        pages.append(tuple(page))
+    return tuple(pages)
+
+
+def fill_lines(words, color, add_line):
+    # Put as many words on each line as fit
+    line = words[0]
     for word in words[1:]:
-        if len(line) < 21 and len(word) + 1 + len(line) < 21:
+        if len(line) < LINE_LENGTH and len(word) + 1 + len(line) < LINE_LENGTH:
             line += ' ' + word
         else:
-            add_line(line, lines)
+            add_line(line, color)
             line = word
-    # Add in last line
-    add_line(line, lines)
-
-
-def split_by_length_in_place(words):
-    for index, word in enumerate(words):
-        n = len(word)
-        if n > 21:
-            insert_offset = 0
-            for x in range(0, n, 20):
-                if x == 0:
-                    words[index] = word[x : x + 20] + '-'
-                else:
-                    word_extension = word[x : x + 20]
-                    if len(word_extension) >= 20:
-                        word_extension += '-'
-                    words.insert(index + insert_offset, word_extension)
-                insert_offset += 1
-    return words
-
-
-def draw_message(canvas, message, font_file):
-    logging.info("Got to draw message")
-    font = graphics.Font()
-    font.LoadFont(font_file)
-    red_color = graphics.Color(255,0,0)
-    yellow_color = graphics.Color(200,125,0)
-    title_divided = message.split(': ', 1)
-
-    title = ''
-    if len(title_divided) == 1:
-        words = split_by_length_in_place(message.split(' '))
-    elif len(title_divided) == 2:
-        title = split_by_length_in_place(title_divided[0])
-        words = split_by_length_in_place(title_divided[1].split(' '))
-    else:
-        words = split_by_length_in_place(message.split(' '))
-        logging.error("Error! Title divided length > 2")
-
-    title_lines = []
-    # Shouldn't need to worry about a word
-    # longer than 21 for now since Silver/Blue/Orange 
-    # is the max # of metro lines per alert assuming all lines
-    # is all lines
-    if title != '':
-        divide_lines(title.split(' '), title_lines)
-
-    lines = []
-    divide_lines(words, lines)
-
-    height_delta = 8
-
-    logging.info("Drawing lines")
+    add_line(line, color)
 
-    for index, title_line in enumerate(title_lines):
-        lines.insert(index, title_line)
 
-    for i in range(0, len(lines), 4):
-        if len(lines) - i < 4:
-            lines_to_display = len(lines) - i
-        else:
-            lines_to_display = 4
-
-        for x in range(0,lines_to_display):
-            color = yellow_color
-            if i+x <= len(title_lines)-1:
-               color = red_color
-            graphics.DrawText(canvas, font, lines[i+x][1], 7 + x*height_delta, color, lines[i+x][0])
-        time.sleep(5)
-        canvas.Clear()
-
-
-def draw_incident(canvas, font_file, message):
-    logging.info("Got to draw incident")
-    height_delta = 8
-    width_delta = 6
+def draw_page(canvas, font_file, page):
+    font = get_font(font_file)
+    for text, x, y, color in page:
+        graphics.DrawText(canvas, font, x, y, get_color(color), text)
 
-    total_width = 128
 
-    font = graphics.Font()
-    font.LoadFont(font_file)
-    red_color = graphics.Color(255,0,0)
-    yellow_color = graphics.Color(200,125,0)
-    green_color = graphics.Color(50,150,0)
+def draw_banner(canvas, font_file, message):
+    font = get_font(font_file)
+    red_color = get_color("red")
 
-    canvas.Clear()
-    
-    for y in range(0, 8):
-        for x in range(0, 32):
-            x0 = x * 4
-            x1 = x0 + 3
-            if x % 2 == 0 and y <= 3:
-                graphics.DrawLine(canvas, x0, y, x1, y, yellow_color)
-            elif x % 2 != 0 and y > 3:
-                graphics.DrawLine(canvas, x0, y, x1, y, yellow_color)
-
-    logging.info("Got past drawing squares")
+    # One blit for the stripes instead of a DrawLine per square
+    canvas.SetImage(get_banner_stripes(), 0, 0)
 
     if "scheduled maintenance" in message or "scheduled track work" in message:
         graphics.DrawText(canvas, font, 1, 15, red_color, "SCHEDULED")
         graphics.DrawText(canvas, font, 1, 23, red_color, "TRACK WORK")
-        logging.info("Drawing scheduled track workd")
     else:
-        logging.info("Drawing service advisory")
         service = "SERVICE"
         advisory = "ADVISORY"
         graphics.DrawText(canvas, font, compute_offset(service), 15, red_color, service)
         graphics.DrawText(canvas, font, compute_offset(advisory), 23, red_color, advisory)
 
-    for y in range(24, 32):
-        for x in range(0, 32):
-            x0 = x * 4
-            x1 = x0 + 3
-            if x % 2 == 0 and y <= 27:
-                graphics.DrawLine(canvas, x0, y, x1, y, yellow_color)
-            elif x % 2 != 0 and y > 27:
-                graphics.DrawLine(canvas, x0, y, x1, y, yellow_color)
 
-    logging.info("Got past drawing other squares")
+def incident_frames(font_file, message):
+    # A banner followed by every page of the message,
+    # each one a function that draws on a canvas
+    yield lambda canvas: draw_banner(canvas, font_file, message)
+    for page in layout_message(message):
+        yield lambda canvas, page=page: draw_page(canvas, font_file, page)
+
+
+class IncidentPlayback:
+    # Plays incidents one frame at a time from the display loop
+    # instead of sleeping, so train times keep being polled and a
+    # station change can cut the playback short.
+    def __init__(self, renderer, font_file):
+        self.renderer = renderer
+        self.font_file = font_file
+        self._frames = None
+        self._deadline = None
+        self._started = None
+
+    @property
+    def active(self):
+        return self._frames != None
+
+    def start(self, messages, now):
+        if len(messages) == 0:
+            return
+        log.info("Playing {} incident(s)".format(len(messages)))
+        self._frames = self._all_frames(messages)
+        self._deadline = now
+        self._started = now
+
+    def stop(self):
+        if self.active:
+            log.info("Incident playback interrupted")
+            display_metrics.observe("metro_incident_playback_seconds", time.monotonic() - self._started)
+        self._frames = None
+        self._deadline = None
+
+    def next_deadline(self):
+        return self._deadline
+
+    # Returns True when playback has just finished and
+    # the train times should go back on the panel.
+    def step(self, now):
+        if not self.active or now < self._deadline:
+            return False
+
+        frame = next(self._frames, None)
+        if frame == None:
+            display_metrics.observe("metro_incident_playback_seconds", now - self._started)
+            self._frames = None
+            self._deadline = None
+            return True
+
+        with display_metrics.timer("metro_frame_render_seconds", "incident"):
+            self.renderer.draw_frame(frame)
+        self._deadline = now + PAGE_SECONDS
+        return False
+
+    def _all_frames(self, messages):
+        for message in messages:
+            for frame in incident_frames(self.font_file, message):
+                yield frame
 
-    time.sleep(5)
 
+def draw_incident(canvas, font_file, message):
+    # Blocking version for running this file on its own
+    for frame in incident_frames(font_file, message):
+        with display_metrics.timer("metro_frame_render_seconds", "incident"):
+            canvas.Clear()
+            frame(canvas)
+        time.sleep(PAGE_SECONDS)
     canvas.Clear()
-    draw_message(canvas, message, font_file)
 
 if __name__ == '__main__':
     if len(sys.argv) != 3:
@@ -225,5 +319,4 @@ if __name__ == '__main__':
     matrix = init_matrix()
     messages = get_incidents(['SV', 'OR', 'GR'], api_key)
     for message in messages:
-        draw_incident(matrix, message, font_file)
-
+        draw_incident(matrix, font_file, message)
@@ -0,0 +1,121 @@
+# Keep what the sign was showing on disk so a restart picks up where it left off
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from trains import Board, Train
+
+log = logging.getLogger(__name__)
+
+STATE_FILE = os.environ.get("STATE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "state.json"))
+
+# The boards are written at most this often, a station change is
+# written right away. Times are counted down after a restart so a
+# board that's a minute old is as good as a new one.
+STATE_SAVE_SECONDS = 60
+
+STATE_FORMAT = 1
+
+# targets are lists of [station code, direction, lines], boards
+# are (Board, time.time() it was fetched) with one for each target
+SavedState = namedtuple('SavedState', ['targets', 'boards'])
+
+
+class StateFile:
+    # args are the station and direction from run.sh. The saved state
+    # is only used if they haven't changed, so editing run.sh still
+    # changes the station even if one was set through the API since.
+    def __init__(self, path, args):
+        self.path = path
+        self.args = list(args)
+        self.restored = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            log.info("No saved state at {}".format(self.path))
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Could not read saved state {}: {}".format(self.path, e))
+            return None
+
+        try:
+            if record['format'] != STATE_FORMAT:
+                log.info("Ignoring saved state in format {}".format(record['format']))
+                return None
+            if record['args'] != self.args:
+                log.info("Station or direction in run.sh changed, ignoring saved state")
+                return None
+            targets = record['targets']
+            if not isinstance(targets, list) or len(targets) == 0:
+                raise ValueError("no targets")
+            for target in targets:
+                if not valid_target(target):
+                    raise ValueError("bad target {}".format(target))
+            boards = []
+            for board in record['boards']:
+                for train in board['trains']:
+                    if not valid_train(train):
+                        raise ValueError("bad train {}".format(train))
+                trains = [Train(*train) for train in board['trains']]
+                boards.append((Board(trains), float(board['fetchedAt'])))
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning("Saved state {} is malformed: {}".format(self.path, e))
+            return None
+
+        self.restored = SavedState(targets, boards)
+        log.info("Restored {} from {}".format(targets, self.path))
+        return self.restored
+
+    def save(self, targets, boards):
+        record = {
+            'format': STATE_FORMAT,
+            'args': self.args,
+            'savedAt': time.time(),
+            'targets': [list(target) for target in targets],
+            'boards': [{'fetchedAt': fetched_at, 'trains': [list(train) for train in board]} for board, fetched_at in boards]
+        }
+
+        # Write a new file and rename it over the old one so a crash
+        # or power cut leaves either the old state or the new one
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+def valid_target(target):
+    # [station code, direction, lines], lines is None or a list of line codes
+    if not isinstance(target, list) or len(target) != 3:
+        return False
+    station_code, direction, lines = target
+    if not isinstance(station_code, str) or not isinstance(direction, str):
+        return False
+    return lines == None or (isinstance(lines, list) and all(isinstance(line, str) for line in lines))
+
+
+def valid_train(train):
+    # [line, car, destination, time], all as they get drawn
+    return isinstance(train, list) and len(train) == len(Train._fields) and all(isinstance(value, str) for value in train)
+
@@ -0,0 +1,199 @@
+# Logging for both processes through one background writer
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import ctypes
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, TimedRotatingFileHandler
+from multiprocessing import Lock, Queue, RawArray, RawValue
+
+# The level every logger starts at, and the lowest level that gets
+# written to the log file. Anything in between only goes to the
+# in-memory buffer the API serves at /logs.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE_LEVEL = os.environ.get("LOG_FILE_LEVEL", "INFO").upper()
+
+# The file is written in batches, whichever of these comes first.
+# Errors are always written right away.
+FLUSH_RECORDS = 50
+FLUSH_SECONDS = 5
+
+# Recent records kept in memory, each cut down to RECORD_SIZE bytes
+BUFFER_RECORDS = 500
+RECORD_SIZE = 256
+LEVELS_SIZE = 1024
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class BatchedFileHandler(TimedRotatingFileHandler):
+    # StreamHandler flushes after every record, which on an SD card
+    # means a write per line. Leave it in the file's buffer until
+    # the writer says the batch is done.
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        TimedRotatingFileHandler.flush(self)
+
+    def close(self):
+        self.flush_batch()
+        TimedRotatingFileHandler.close(self)
+
+
+class LogPipeline:
+    # Every process logs into one queue. A thread in the parent
+    # process takes records off it, writes them to the log file in
+    # batches and keeps the most recent ones in shared memory for
+    # the API. Logger levels live in shared memory too so the API
+    # can change them for the display process while it runs.
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.queue = Queue(-1)
+        self._lock = Lock()
+        self._records = RawArray(ctypes.c_char, BUFFER_RECORDS * RECORD_SIZE)
+        self._record_levels = RawArray(ctypes.c_ubyte, BUFFER_RECORDS)
+        self._written = RawValue(ctypes.c_ulong, 0)
+        self._levels = RawArray(ctypes.c_char, LEVELS_SIZE)
+        self._levels_version = RawValue(ctypes.c_ulong, 0)
+        # Per process, it's copied on fork
+        self._applied_levels = {}
+        self._applied_version = -1
+        self._writer = None
+
+    def start(self):
+        handler = BatchedFileHandler(self.log_file, when="d", interval=1, backupCount=5)
+        handler.setLevel(LOG_FILE_LEVEL)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        self._writer = LogWriter(self, handler)
+        self._writer.start()
+        self.install()
+
+    def stop(self):
+        if self._writer != None:
+            self.queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def install(self):
+        # Send everything this process logs to the queue
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(QueueHandler(self.queue))
+        root.setLevel(LOG_LEVEL)
+        self.apply_levels()
+
+    def set_levels(self, levels):
+        # levels is {"logger name": "LEVEL"}, "root" for the default
+        for name, level in levels.items():
+            if not isinstance(logging.getLevelName(str(level).upper()), int):
+                raise ValueError("Unknown log level {} for {}".format(level, name))
+        record = json.dumps({name: str(level).upper() for name, level in levels.items()}).encode()
+        if len(record) >= LEVELS_SIZE:
+            raise ValueError("Too many log levels: {} bytes".format(len(record)))
+        with self._lock:
+            self._levels.value = record
+            self._levels_version.value += 1
+        self.apply_levels()
+
+    def levels(self):
+        with self._lock:
+            record = self._levels.value
+        return json.loads(record.decode()) if record else {}
+
+    def apply_levels(self):
+        # Cheap enough to call on every loop, it only does anything
+        # when the levels were changed since this process last looked
+        if self._levels_version.value == self._applied_version:
+            return
+        with self._lock:
+            version = self._levels_version.value
+            record = self._levels.value
+        levels = json.loads(record.decode()) if record else {}
+
+        # Loggers that no longer have a level go back to the default
+        for name in self._applied_levels:
+            if name not in levels:
+                logging.getLogger(None if name == "root" else name).setLevel(LOG_LEVEL if name == "root" else logging.NOTSET)
+        for name, level in levels.items():
+            logging.getLogger(None if name == "root" else name).setLevel(level)
+        self._applied_levels = levels
+        self._applied_version = version
+
+    def add_recent(self, levelno, line):
+        data = line.encode("utf-8", "replace")[:RECORD_SIZE - 1]
+        with self._lock:
+            slot = self._written.value % BUFFER_RECORDS
+            start = slot * RECORD_SIZE
+            self._records[start:start + len(data)] = data
+            self._records[start + len(data)] = b"\0"
+            self._record_levels[slot] = min(levelno, 255)
+            self._written.value += 1
+
+    def recent(self, limit=BUFFER_RECORDS, min_level=logging.NOTSET):
+        # Oldest first, like the file
+        with self._lock:
+            written = self._written.value
+            records = self._records.raw
+            record_levels = self._record_levels[:]
+
+        lines = []
+        for n in range(max(0, written - BUFFER_RECORDS), written):
+            slot = n % BUFFER_RECORDS
+            if record_levels[slot] < min_level:
+                continue
+            start = slot * RECORD_SIZE
+            lines.append(records[start:start + RECORD_SIZE].split(b"\0", 1)[0].decode("utf-8", "replace"))
+        return lines[-limit:] if limit > 0 else []
+
+
+class LogWriter(threading.Thread):
+    def __init__(self, pipeline, handler):
+        threading.Thread.__init__(self, name="log-writer", daemon=True)
+        self.pipeline = pipeline
+        self.handler = handler
+        self.formatter = logging.Formatter(FORMAT)
+
+    def run(self):
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self.pipeline.queue.get(timeout=FLUSH_SECONDS)
+            except queue.Empty:
+                record = False
+
+            if record == None:
+                break
+            if record:
+                self.pipeline.add_recent(record.levelno, self.formatter.format(record))
+                if record.levelno >= self.handler.level:
+                    self.handler.handle(record)
+                    pending += 1
+
+            now = time.monotonic()
+            if pending > 0 and (pending >= FLUSH_RECORDS or now - last_flush >= FLUSH_SECONDS or
+                                (record and record.levelno >= logging.ERROR)):
+                self.handler.flush_batch()
+                pending = 0
+                last_flush = now
+
+        self.handler.close()
@@ -0,0 +1,31 @@
+# Picks the real LED matrix library or the in-memory stand-in
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# VIRTUAL_MATRIX=1 draws into memory (see virtual_matrix.py) instead
+# of on the panel. Without it rgbmatrix has to be installed, a sign
+# that can't draw should fail to start rather than run blank.
+VIRTUAL = os.environ.get("VIRTUAL_MATRIX", "0") == "1"
+
+if VIRTUAL:
+    log.info("Drawing to a virtual matrix")
+    from virtual_matrix import RGBMatrix, RGBMatrixOptions, graphics
+else:
+    from rgbmatrix import RGBMatrix, RGBMatrixOptions, graphics
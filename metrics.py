@@ -0,0 +1,183 @@
+# Timing statistics for rpi-metro-display
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from collections import deque
+from contextlib import contextmanager
+import ctypes
+import threading
+import time
+from multiprocessing import Lock, RawArray
+
+# Percentiles are computed over this many of the most recent samples
+SAMPLE_SIZE = 1000
+
+
+class LatencyRecorder:
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples == None:
+                samples = deque(maxlen=self.sample_size)
+                self._samples[key] = samples
+                self._counts[key] = 0
+            samples.append(seconds)
+            self._counts[key] += 1
+
+    def summary(self):
+        with self._lock:
+            snapshot = {key: (self._counts[key], sorted(samples)) for key, samples in self._samples.items()}
+
+        result = {}
+        for key, (count, samples) in snapshot.items():
+            result[key] = {
+                "count": count,
+                "p50": percentile(samples, 50),
+                "p90": percentile(samples, 90),
+                "p99": percentile(samples, 99),
+                "max": samples[-1]
+            }
+        return result
+
+
+def percentile(sorted_samples, pct):
+    if len(sorted_samples) == 0:
+        return 0.0
+    # Nearest rank
+    index = int(round(pct / 100.0 * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+# Histogram buckets in seconds, from a fast frame to a slow WMATA call
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (kind, help, label name, label values). Everything the
+# display reports is listed here up front so it fits in one fixed
+# block of shared memory the API process can read.
+DISPLAY_METRICS = {
+    "metro_wmata_request_seconds": ("histogram", "Time to get and parse a response from WMATA, retries included.", "endpoint", ("GetPrediction", "Incidents")),
+    "metro_wmata_requests_total": ("counter", "Requests made to WMATA.", "endpoint", ("GetPrediction", "Incidents")),
+    "metro_wmata_failures_total": ("counter", "Requests to WMATA that failed or returned something unusable.", "endpoint", ("GetPrediction", "Incidents")),
+    "metro_wmata_requests_last_minute": ("gauge", "HTTP requests made to WMATA in the last 60 seconds, retries included.", "client", ("display", "proxy")),
+    "metro_wmata_retries_total": ("counter", "Requests to WMATA that were tried again after a connection error or 5xx.", "endpoint", ("GetPrediction", "Incidents")),
+    "metro_frame_render_seconds": ("histogram", "Time to draw a frame and swap it onto the panel.", "kind", ("board", "incident")),
+    "metro_poll_cycle_seconds": ("histogram", "Time from asking for predictions to them being on the panel.", None, (None,)),
+    "metro_incident_playback_seconds": ("histogram", "How long incidents held the panel each time they played.", None, (None,)),
+    "metro_font_loads_total": ("counter", "Times a BDF font file was parsed.", None, (None,)),
+    "metro_prediction_age_seconds": ("age", "Seconds since predictions were last fetched successfully.", None, (None,)),
+    "metro_proxy_requests_total": ("counter", "Requests from other signs answered by the proxy.", "result", ("hit", "miss", "coalesced"))
+}
+
+
+class SharedMetrics:
+    # Counters, histograms and ages kept in shared memory. The display
+    # process records into it and the API process renders it for
+    # /metrics. Every series gets a fixed slice of one array of doubles.
+    def __init__(self, definitions=DISPLAY_METRICS, buckets=BUCKETS):
+        self.definitions = definitions
+        self.buckets = buckets
+        self._offsets = {}
+        size = 0
+        for name, (kind, help_text, label, values) in definitions.items():
+            for value in values:
+                self._offsets[(name, value)] = size
+                # A histogram is a count per bucket plus +Inf, sum and count
+                size += len(buckets) + 3 if kind == "histogram" else 1
+        self._values = RawArray(ctypes.c_double, size)
+        self._lock = Lock()
+
+    def observe(self, name, seconds, label=None):
+        offset = self._offsets[(name, label)]
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        end = offset + len(self.buckets) + 1
+        with self._lock:
+            self._values[offset + index] += 1
+            self._values[end] += seconds
+            self._values[end + 1] += 1
+
+    @contextmanager
+    def timer(self, name, label=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, label)
+
+    def inc(self, name, label=None, amount=1):
+        offset = self._offsets[(name, label)]
+        with self._lock:
+            self._values[offset] += amount
+
+    def set(self, name, value, label=None):
+        self._values[self._offsets[(name, label)]] = value
+
+    def touch(self, name, label=None):
+        # time.monotonic() is system wide, so the API process
+        # can turn this into an age when it renders
+        self._values[self._offsets[(name, label)]] = time.monotonic()
+
+    def render(self):
+        with self._lock:
+            values = self._values[:]
+        now = time.monotonic()
+
+        lines = []
+        for name, (kind, help_text, label, label_values) in self.definitions.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, "gauge" if kind == "age" else kind))
+            for value in label_values:
+                offset = self._offsets[(name, value)]
+                labels = '{}="{}"'.format(label, value) if label != None else ""
+                if kind == "histogram":
+                    cumulative = 0
+                    for i, bound in enumerate(self.buckets + ("+Inf",)):
+                        cumulative += values[offset + i]
+                        bucket_labels = 'le="{}"'.format(bound) if labels == "" else '{},le="{}"'.format(labels, bound)
+                        lines.append("{}_bucket{{{}}} {}".format(name, bucket_labels, format_value(cumulative)))
+                    end = offset + len(self.buckets) + 1
+                    lines.append("{}_sum{} {}".format(name, wrap_labels(labels), format_value(values[end])))
+                    lines.append("{}_count{} {}".format(name, wrap_labels(labels), format_value(values[end + 1])))
+                elif kind == "age":
+                    # Nothing to report until it's been touched once
+                    if values[offset] > 0:
+                        lines.append("{}{} {}".format(name, wrap_labels(labels), format_value(now - values[offset])))
+                else:
+                    lines.append("{}{} {}".format(name, wrap_labels(labels), format_value(values[offset])))
+        return "\n".join(lines) + "\n"
+
+
+def wrap_labels(labels):
+    return "{" + labels + "}" if labels != "" else ""
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+# Made when this module is first imported, which is before the
+# display and API processes fork, so they both see the same memory
+display_metrics = SharedMetrics()
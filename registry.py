@@ -0,0 +1,336 @@
+# In-memory index of the cached WMATA stations and lines files
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from utils import sanitize_input
+
+log = logging.getLogger(__name__)
+
+# How often (in seconds) we're willing to stat the data
+# files to see if the update scripts have rewritten them.
+RELOAD_CHECK_SECONDS = 10
+
+# Bump this whenever the snapshot layout changes so an old
+# snapshot gets refused instead of breaking a lookup later on
+SNAPSHOT_SCHEMA = 1
+
+# One registry per (stations, lines) pair per process. The Flask
+# process and the display process each build their own after fork.
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def get_registry(stations_path, lines_path):
+    key = (stations_path, lines_path)
+    registry = _registries.get(key)
+    if registry == None:
+        with _registries_lock:
+            registry = _registries.get(key)
+            if registry == None:
+                registry = TransitRegistry(stations_path, lines_path)
+                _registries[key] = registry
+    return registry
+
+
+def build_tables(stations, lines):
+    stations_by_code = {}
+    for station in stations:
+        stations_by_code[station['Code']] = station
+
+    # Direction "1" heads toward a line's EndStationCode and
+    # anything else toward its StartStationCode.
+    line_terminals = {}
+    terminal_directions = {}
+    for line in lines:
+        terminals = {}
+        for direction, code in (("1", line['EndStationCode']), ("2", line['StartStationCode'])):
+            terminal = stations_by_code.get(code)
+            terminals[direction] = terminal['Name'] if terminal != None else ''
+            # Keep the first line that terminates at a station, the
+            # same answer the old scan over the lines file gave.
+            terminal_directions.setdefault(code, direction)
+        line_terminals[line['LineCode']] = terminals
+
+    station_terminals = {}
+    for station in stations:
+        by_direction = {}
+        for direction in ("1", "2"):
+            terminals = []
+            for line_code in station_line_codes(station):
+                terminal = line_terminals.get(line_code, {}).get(direction)
+                # Some lines share a terminal station
+                if terminal != None and terminal not in terminals:
+                    terminals.append(terminal)
+            by_direction[direction] = terminals
+        station_terminals[station['Code']] = by_direction
+
+    # Every prefix of every word in a station's name, pointing
+    # at the stations (by position in the file) that have it
+    prefix_index = {}
+    for position, station in enumerate(stations):
+        for word in station['Name'].split():
+            for end in range(1, len(word) + 1):
+                positions = prefix_index.setdefault(word[:end], [])
+                if position not in positions:
+                    positions.append(position)
+
+    # Plain dicts and lists so the whole thing can go in a snapshot
+    return {
+        "lineTerminals": line_terminals,
+        "stationTerminals": station_terminals,
+        "terminalDirections": terminal_directions,
+        "prefixIndex": prefix_index
+    }
+
+
+def write_snapshot(path, stations, lines):
+    data = {
+        "Stations": stations,
+        "Lines": lines,
+        "tables": build_tables(stations, lines)
+    }
+    payload = json.dumps(data, separators=(',', ':')).encode()
+    header = {
+        "schema": SNAPSHOT_SCHEMA,
+        "generated": int(time.time()),
+        "length": len(payload),
+        "sha256": hashlib.sha256(payload).hexdigest()
+    }
+
+    # Write next to the real file and rename over it so the
+    # display never reads a half written snapshot
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json.dumps(header).encode())
+        f.write(b"\n")
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    # One line of header then the payload, read in one go
+    with open(path, "rb") as f:
+        raw = f.read()
+
+    header_line, _, payload = raw.partition(b"\n")
+    try:
+        header = json.loads(header_line.decode())
+    except ValueError:
+        raise SnapshotError("{} is not a transit snapshot".format(path))
+
+    if header.get('schema') != SNAPSHOT_SCHEMA:
+        raise SnapshotError("{} has schema {}, expected {}. Run updateTransitData.py again.".format(path, header.get('schema'), SNAPSHOT_SCHEMA))
+    if header.get('length') != len(payload) or header.get('sha256') != hashlib.sha256(payload).hexdigest():
+        raise SnapshotError("{} is corrupt, checksum does not match".format(path))
+
+    return header, json.loads(payload.decode())
+
+
+class TransitRegistry:
+    # Passing the same path for stations and lines means
+    # it's a snapshot from updateTransitData.py
+    def __init__(self, stations_path, lines_path):
+        self.stations_path = stations_path
+        self.lines_path = lines_path
+        self.snapshot = stations_path == lines_path
+        self._lock = threading.RLock()
+        self._stations_mtime = None
+        self._lines_mtime = None
+        self._last_check = 0
+        self.loads = 0
+
+        self.stations = []
+        self.lines = []
+        self._stations_by_code = {}
+        self._lines_by_code = {}
+        self._lines_by_name = {}
+        self._line_terminals = {}
+        self._station_terminals = {}
+        self._terminal_directions = {}
+        self._prefix_index = {}
+
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_check < RELOAD_CHECK_SECONDS:
+            return False
+
+        with self._lock:
+            self._last_check = now
+            stations_mtime = os.stat(self.stations_path).st_mtime_ns
+            lines_mtime = os.stat(self.lines_path).st_mtime_ns
+            if not force and \
+                stations_mtime == self._stations_mtime and \
+                lines_mtime == self._lines_mtime:
+                return False
+
+            try:
+                stations, lines, tables = self._load()
+            except (OSError, ValueError, KeyError) as e:
+                if self.loads == 0:
+                    raise
+                # Keep answering from what we already have rather
+                # than failing in the middle of a lookup
+                log.error("Could not reload transit data, keeping the old copy: {}".format(e))
+                self._stations_mtime = stations_mtime
+                self._lines_mtime = lines_mtime
+                return False
+
+            self._install(stations, lines, tables)
+            self._stations_mtime = stations_mtime
+            self._lines_mtime = lines_mtime
+            self.loads += 1
+            log.info("Loaded {} stations and {} lines.".format(len(stations), len(lines)))
+            return True
+
+    def _load(self):
+        if self.snapshot:
+            header, data = read_snapshot(self.stations_path)
+            log.info("Transit snapshot generated {}".format(time.ctime(header['generated'])))
+            return data['Stations'], data['Lines'], data['tables']
+
+        with open(self.stations_path) as sf:
+            stations = json.load(sf)['Stations']
+        with open(self.lines_path) as lf:
+            lines = json.load(lf)['Lines']
+        return stations, lines, build_tables(stations, lines)
+
+    def _install(self, stations, lines, tables):
+        stations_by_code = {}
+        for station in stations:
+            stations_by_code[station['Code']] = station
+
+        lines_by_code = {}
+        lines_by_name = {}
+        for line in lines:
+            lines_by_code[line['LineCode']] = line
+            lines_by_name.setdefault(line['DisplayName'], line)
+
+        prefix_index = {}
+        for prefix, positions in tables['prefixIndex'].items():
+            prefix_index[prefix] = set(positions)
+
+        # Swap everything in at once so readers never see
+        # half of an old index and half of a new one.
+        self.stations = stations
+        self.lines = lines
+        self._stations_by_code = stations_by_code
+        self._lines_by_code = lines_by_code
+        self._lines_by_name = lines_by_name
+        self._line_terminals = tables['lineTerminals']
+        self._station_terminals = tables['stationTerminals']
+        self._terminal_directions = tables['terminalDirections']
+        self._prefix_index = prefix_index
+
+    def station_by_code(self, code):
+        self.refresh()
+        return self._stations_by_code.get(code)
+
+    def station_by_name(self, station_name, station_lines=None):
+        for station in self.search_stations(station_name):
+            if station_lines == None:
+                return station
+            elif len(set(station_line_codes(station)) & set(station_lines)) > 0:
+                return station
+        return None
+
+    def search_stations(self, query, limit=None):
+        self.refresh()
+        query = sanitize_input(query).strip()
+        if query == "":
+            return []
+
+        # Every word of the query has to start one of the words in
+        # the station's name, in any order
+        candidates = None
+        for word in query.split():
+            matches = self._prefix_index.get(word, set())
+            candidates = matches if candidates == None else candidates & matches
+
+        ranked = [(self._rank(query, self.stations[position]['Name']), position) for position in candidates]
+
+        # Nothing starts with it, so fall back to the substring match
+        # the API has always done (e.g. 'enfant' for 'lenfant plaza')
+        if len(ranked) == 0:
+            for position, station in enumerate(self.stations):
+                if query in station['Name']:
+                    ranked.append((3, position))
+
+        # Best rank first, ties go to whichever comes first in the file
+        ranked.sort()
+        if limit != None:
+            # A negative limit would slice from the end
+            ranked = ranked[:max(0, limit)]
+        return [self.stations[position] for rank, position in ranked]
+
+    def _rank(self, query, name):
+        if name == query:
+            return 0
+        elif name.startswith(query):
+            return 1
+        return 2
+
+    def line_by_code(self, line_code):
+        self.refresh()
+        return self._lines_by_code.get(line_code)
+
+    def line_code_by_name(self, display_name):
+        self.refresh()
+        line = self._lines_by_name.get(sanitize_input(display_name))
+        if line == None:
+            return None
+        return line['LineCode']
+
+    def line_terminal(self, line_code, direction):
+        self.refresh()
+        if direction != "1":
+            direction = "2"
+        return self._line_terminals.get(line_code, {}).get(direction)
+
+    def station_terminals(self, station_code, direction):
+        self.refresh()
+        if direction != "1":
+            direction = "2"
+        return list(self._station_terminals.get(station_code, {}).get(direction, []))
+
+    def direction_to_terminal(self, terminal_code):
+        self.refresh()
+        return self._terminal_directions.get(terminal_code)
+
+
+def station_line_codes(station):
+    lines = []
+
+    # There are 4 possible line codes per
+    # station. Each formatted as LineCodeX
+    # where x is an integer.
+    for x in range(1,5):
+        line_code = station['LineCode{}'.format(x)]
+        if line_code != None and line_code != "":
+            lines.append(line_code)
+
+    return lines
@@ -0,0 +1,80 @@
+# Render sample frames on the virtual matrix and report how long they took
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import os
+import sys
+
+# Always the virtual matrix, even if rgbmatrix is installed
+os.environ["VIRTUAL_MATRIX"] = "1"
+
+import importlib.util
+from metrics import percentile
+from renderer import FrameRenderer
+from incidents import incident_frames
+from trains import Board, Train
+
+if len(sys.argv) not in (3, 4):
+    print("Usage renderFrames.py <font_file> <output_dir> [repeats]")
+    sys.exit(2)
+
+font_file = sys.argv[1]
+output_dir = sys.argv[2]
+repeats = int(sys.argv[3]) if len(sys.argv) == 4 else 100
+os.makedirs(output_dir, exist_ok=True)
+
+# The main script has a dash in its name so it can't just be imported
+spec = importlib.util.spec_from_file_location("metro_display", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpi-metro-display.py"))
+display = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(display)
+
+def sample_board(minute):
+    # Times count down from minute to minute like the real thing
+    return Board([
+        Train("OR", "8", "Vienna", "ARR" if minute == 0 else str(minute)),
+        Train("SV", "6", "Ashburn", str(minute + 4)),
+        Train("BL", "8", "Franconia", str(minute + 11))
+    ])
+
+incident = "Orange Line: Trains single tracking between Vienna and West Falls Church due to scheduled track work."
+
+# (name, function drawing frame i on a FrameRenderer) for each kind
+# of frame. "board" is drawn from scratch every time, "board-update"
+# only redraws the rows that changed since the last frame.
+scenes = [
+    ("board", lambda renderer, i: (renderer.invalidate(), display.draw_display(renderer, font_file, sample_board(5)))),
+    ("board-update", lambda renderer, i: display.draw_display(renderer, font_file, sample_board(i % 10))),
+]
+for index, frame in enumerate(incident_frames(font_file, incident)):
+    scenes.append(("incident-{}".format(index), lambda renderer, i, frame=frame: renderer.draw_frame(frame)))
+
+print("{:<14} {:>10} {:>12} {:>12}".format("frame", "draw calls", "p50 ms", "max ms"))
+for name, draw in scenes:
+    matrix = display.init_matrix()
+    renderer = FrameRenderer(matrix)
+    # The first couple of frames fill both buffers, don't count them
+    draw(renderer, 0)
+    draw(renderer, 1)
+    matrix.reset_stats()
+
+    for i in range(2, repeats + 2):
+        draw(renderer, i)
+
+    calls = sorted(draw_calls for draw_calls, seconds in matrix.frame_stats)
+    times = sorted(seconds for draw_calls, seconds in matrix.frame_stats)
+    print("{:<14} {:>10} {:>12.3f} {:>12.3f}".format(name, percentile(calls, 50), percentile(times, 50) * 1000, times[-1] * 1000))
+    matrix.save_png(os.path.join(output_dir, name + ".png"), scale=4)
+
+print("Frames saved to {}".format(output_dir))
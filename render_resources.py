@@ -0,0 +1,110 @@
+# Fonts and colors shared by everything that draws on the matrix
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import logging
+import os
+import threading
+import time
+from PIL import Image, ImageDraw
+from matrix_backend import graphics
+from metrics import display_metrics
+
+log = logging.getLogger(__name__)
+
+PALETTE = {
+    "red": (255,0,0),
+    "yellow": (200,125,0),
+    "green": (50,150,0),
+    "black": (0,0,0)
+}
+
+# path -> (mtime, font, when mtime was last checked). Parsing a
+# BDF file off the SD card is slow so only do it again if the file
+# actually changed, and only look at the file every so often so
+# drawing a frame doesn't touch the filesystem.
+FONT_CHECK_SECONDS = 10
+_fonts = {}
+_colors = {}
+_lock = threading.Lock()
+font_loads = 0
+
+# The checkered stripes above and below an incident banner.
+# They never change, so they're drawn once into an image.
+BANNER_WIDTH = 128
+BANNER_HEIGHT = 32
+BANNER_SQUARE = 4
+_banner = None
+
+# (width, height) -> all black image, for wiping part of a canvas in one call
+_strips = {}
+
+
+def get_font(font_file):
+    global font_loads
+    now = time.monotonic()
+    cached = _fonts.get(font_file)
+    if cached != None and now - cached[2] < FONT_CHECK_SECONDS:
+        return cached[1]
+
+    mtime = os.stat(font_file).st_mtime_ns
+    with _lock:
+        cached = _fonts.get(font_file)
+        if cached != None and cached[0] == mtime:
+            _fonts[font_file] = (mtime, cached[1], now)
+            return cached[1]
+        font = graphics.Font()
+        font.LoadFont(font_file)
+        _fonts[font_file] = (mtime, font, now)
+        font_loads += 1
+        display_metrics.inc("metro_font_loads_total")
+        log.info("Loaded font {} (font loads: {})".format(font_file, font_loads))
+        return font
+
+
+def get_color(name):
+    color = _colors.get(name)
+    if color == None:
+        r, g, b = PALETTE[name]
+        color = graphics.Color(r, g, b)
+        _colors[name] = color
+    return color
+
+
+def get_black_strip(width, height):
+    strip = _strips.get((width, height))
+    if strip == None:
+        strip = Image.new("RGB", (width, height), PALETTE["black"])
+        _strips[(width, height)] = strip
+    return strip
+
+
+def get_banner_stripes():
+    global _banner
+    if _banner != None:
+        return _banner
+
+    image = Image.new("RGB", (BANNER_WIDTH, BANNER_HEIGHT), PALETTE["black"])
+    draw = ImageDraw.Draw(image)
+    # Two rows of squares at the top and two at the bottom,
+    # every other square lit and offset on the second row
+    for top in (0, BANNER_HEIGHT - 2 * BANNER_SQUARE):
+        for row in range(2):
+            y = top + row * BANNER_SQUARE
+            for x in range(row * BANNER_SQUARE, BANNER_WIDTH, 2 * BANNER_SQUARE):
+                draw.rectangle((x, y, x + BANNER_SQUARE - 1, y + BANNER_SQUARE - 1), fill=PALETTE["yellow"])
+    _banner = image
+    return _banner
+
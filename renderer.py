@@ -0,0 +1,111 @@
+# Double-buffered drawing for the matrix
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from render_resources import get_black_strip
+
+TOTAL_WIDTH = 128
+ROW_HEIGHT = 8
+FIRST_BASELINE = 7
+
+# The 6x10 font draws from 8 pixels above the baseline to 1 below,
+# so neighbouring rows overlap a little.
+FONT_ASCENT = 8
+FONT_DESCENT = 1
+
+
+def row_baseline(index):
+    return FIRST_BASELINE + index * ROW_HEIGHT
+
+
+class FrameRenderer:
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.canvas = matrix.CreateFrameCanvas()
+        self.width = getattr(matrix, "width", TOTAL_WIDTH)
+        # What each buffer is currently showing, as a list of rows.
+        # None means we don't know (first frame, or something else
+        # drew on it) and it has to be redrawn from scratch.
+        self._front_rows = None
+        self._back_rows = None
+        self.frames = 0
+        self.rows_drawn = 0
+
+    def invalidate(self):
+        self._front_rows = None
+        self._back_rows = None
+
+    def update_rows(self, rows, draw_row):
+        if self._front_rows != None and self._front_rows == rows:
+            return False
+
+        canvas = self.canvas
+        prev = self._back_rows
+
+        if prev == None:
+            canvas.Clear()
+            to_draw = range(len(rows))
+        else:
+            dirty = []
+            for i in range(max(len(rows), len(prev))):
+                new_row = rows[i] if i < len(rows) else None
+                old_row = prev[i] if i < len(prev) else None
+                if new_row != old_row:
+                    dirty.append(i)
+
+            # Clearing a row also wipes the descenders of the row above
+            # and the top of the row below, so those get drawn again too.
+            redraw = set()
+            for i in dirty:
+                redraw.update((i - 1, i, i + 1))
+            to_draw = sorted(i for i in redraw if 0 <= i < len(rows))
+
+            # One clear per dirty row plus the rows around them. When
+            # that's no cheaper than clearing everything and drawing
+            # every row, do that instead.
+            if len(dirty) + len(to_draw) >= len(rows) + 1:
+                canvas.Clear()
+                to_draw = range(len(rows))
+            else:
+                for i in dirty:
+                    self._clear_row(canvas, i)
+
+        for i in to_draw:
+            draw_row(canvas, row_baseline(i), rows[i])
+            self.rows_drawn += 1
+
+        self._swap()
+        self._front_rows = list(rows)
+        return True
+
+    def draw_frame(self, draw):
+        self.canvas.Clear()
+        draw(self.canvas)
+        self._swap()
+        self._front_rows = None
+
+    def _swap(self):
+        # After the swap the offscreen canvas is whatever was on
+        # screen before, so its contents are the old front rows.
+        self.canvas = self.matrix.SwapOnVSync(self.canvas)
+        self._back_rows = self._front_rows
+        self.frames += 1
+
+    def _clear_row(self, canvas, index):
+        # One blit of a black strip instead of a line per pixel row
+        baseline = row_baseline(index)
+        top = max(0, baseline - FONT_ASCENT)
+        bottom = baseline + FONT_DESCENT + 1
+        canvas.SetImage(get_black_strip(self.width, bottom - top), 0, top)
@@ -14,100 +14,373 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
-from rgbmatrix import RGBMatrix, RGBMatrixOptions, graphics
-from flask import Flask, jsonify, request, current_app
-from multiprocessing import Process, Pipe
+from matrix_backend import RGBMatrix, RGBMatrixOptions, graphics
+from flask import Flask, jsonify, request, current_app, g
+from multiprocessing import Process
 from multiprocessing.sharedctypes import Value
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+import asyncio
 import ctypes
+import os
 import traceback
 import time
 import sys
-import requests
-import json
 import logging
-from incidents import get_incidents, draw_incident
-from logging.handlers import TimedRotatingFileHandler
+from render_resources import get_font, get_color
+from renderer import FrameRenderer
+from incidents import fetch_incidents, IncidentStore, IncidentPlayback
+from scheduler import RequestBudget, PollScheduler
+from control import ControlBlock
+from metrics import LatencyRecorder, display_metrics
+from registry import get_registry, station_line_codes, SnapshotError
+from trains import Board, EMPTY_BOARD, PredictionCache, parse_value, target_key, train_from_prediction
+from utils import sanitize_input
+from wmata_client import get_client, set_default_base_url
+from wmata_proxy import WMATA_PROXY, WMATAProxy
+from log_pipeline import LogPipeline
+from last_state import STATE_FILE, STATE_SAVE_SECONDS, StateFile
 from traceback import format_exception
 
+log = logging.getLogger("display")
+# The Flask routes run in their own process, keep them apart in /logs
+api_log = logging.getLogger("api")
+
 app = Flask(__name__)
 
+# "dev" runs Flask's built in server, "waitress" runs the
+# same app on waitress with a fixed number of worker threads
+API_SERVER = os.environ.get("API_SERVER", "dev")
+API_PORT = int(os.environ.get("API_PORT", 5000))
+API_THREADS = int(os.environ.get("API_THREADS", 4))
+API_TIMEOUT_SECONDS = int(os.environ.get("API_TIMEOUT_SECONDS", 30))
+
+route_latency = LatencyRecorder()
+
 # Global shared variables
 stations_file = None
 lines_file = None
 
 def exception_hook(exctype, value, tb):
-    logging.error("Uncaught exception!")
-    logging.error('Type: {}'.format(exctype))
-    logging.error('Value: {}'.format(value))
-    logging.error('TB: {}'.format(tb))
+    log.error("Uncaught exception!")
+    log.error('Type: {}'.format(exctype))
+    log.error('Value: {}'.format(value))
+    log.error('TB: {}'.format(tb))
     for s in format_exception(exctype, value, tb):
-        logging.error(s)
-
-def show_train_times(api_key, font_file, canvas, station_code, direction, prev_lines, prev_cars, prev_dests, prev_times, force_update):
-    lines, cars, dests, times = get_train_data(api_key, station_code, direction)
-    if lines == None and \
-        cars == None and \
-        dests == None and \
-        times == None:
-        lines, cars, dests, times = prev_lines, prev_cars, prev_dests, prev_times
-        logging.error("Error getting update from WMATA API.")
-    elif lines != prev_lines or \
-        cars != prev_cars or \
-        dests != prev_dests or \
-        times != prev_times:
-        force_update = True
-    elif force_update: 
-        # Needed after an incident is displayed and the train times haven't changed
-        # Realistically I could do without this condition because it's only a log
-        # but to me it's nice to have
-        logging.debug("Times did not change but a display update was foced.")
-    else:
-        logging.debug("No update")
-
-    if force_update:
-        draw_display(canvas, font_file, lines, cars, dests, times)
+        log.error(s)
+
+INCIDENT_CHECK_SECONDS = 60
+# With more stations than fit on the panel, how long each one stays up
+TARGET_ROTATE_SECONDS = 10
+BOARD_WIDTH = 128
+
+# One board on the sign: a station platform and, optionally,
+# the only lines to show there
+Target = namedtuple('Target', ['station_code', 'direction', 'lines'])
+
+# The header row of a board, stale has a flag for each tile
+Header = namedtuple('Header', ['stale'])
+
+def parse_targets(station_arg, direction_arg):
+    # Stations are comma separated, each optionally followed by a
+    # colon and a '+' separated list of lines, e.g. "A01,C01:BL+OR".
+    # Directions are either one per station or one for all of them.
+    stations = station_arg.split(',')
+    directions = direction_arg.split(',')
+    if len(directions) == 1:
+        directions = directions * len(stations)
+    elif len(directions) != len(stations):
+        raise ValueError("Expected 1 or {} directions, got {}".format(len(stations), len(directions)))
+
+    targets = []
+    for station, direction in zip(stations, directions):
+        lines = None
+        if ':' in station:
+            station, line_arg = station.split(':', 1)
+            lines = line_arg.upper().split('+')
+        targets.append(Target(station.strip(), direction.strip(), lines))
+    return targets
+
+async def wait_for_event(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+class DisplayLoop:
+    # Predictions, incidents and incident playback each run as their
+    # own task on one event loop. The HTTP calls happen on a small
+    # thread pool so a slow endpoint only holds up its own task, and
+    # all drawing happens on the loop itself.
+    def __init__(self, api_key, font_file, renderer, control, logs=None, state=None, started=None):
+        self.api_key = api_key
+        self.font_file = font_file
+        self.renderer = renderer
+        self.control = control
+        self.logs = logs
+        # Where the targets and boards are saved, and when that last
+        # happened. started is when the program started, for logging
+        # how long the first frames took.
+        self.state = state
+        self.saved_at = None
+        self.started = started if started != None else time.monotonic()
+        self.live = False
+        self.control_version, targets = read_control(control)
+        self.applied_version = 0
+        self.targets = targets
+        # When the change being switched to was published
+        self.change_started = None
+        self.playback = IncidentPlayback(renderer, font_file)
+        self.incident_store = IncidentStore()
+        # Counts every request the client makes, retries included
+        self.budget = RequestBudget()
+        get_client(api_key).budget = self.budget
+        self.scheduler = PollScheduler(self.budget)
+        self.force_update = False
+
+        # The last good board for each target, and what's on the
+        # panel now: one Board per target, counted down from the
+        # cached one, and whether each is stale
+        self.cache = PredictionCache()
+        self.boards = tuple(EMPTY_BOARD for target in targets)
+        self.stale = tuple(False for target in targets)
+        self.rotation = 0
+        self.restore_boards()
+
+        # Created in run() so they belong to the running loop
+        self.poll_now = None
+        self.playback_changed = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=2))
+        self.poll_now = asyncio.Event()
+        self.playback_changed = asyncio.Event()
+
+        loop.add_reader(self.control.wake_fd(), self.on_control_wake)
+
+        self.draw_board()
+        log.info("First frame {:.3f}s after start ({})".format(time.monotonic() - self.started,
+                 "saved times" if any(len(board) > 0 for board in self.boards) else "no saved times"))
+        await asyncio.gather(self.poll_predictions(), self.count_down(), self.poll_incidents(), self.play_incidents(), self.rotate_boards())
+
+    def on_control_wake(self):
+        self.control.drain_wake()
+        if self.control.version() == self.control_version:
+            return
+        # However many changes came in since we last looked,
+        # only the latest one matters
+        self.control_version, targets = read_control(self.control)
+        self.change_started = self.control.published_at()
+        self.set_targets(targets)
+
+    def set_targets(self, targets):
+        log.info("Switching to {}".format(targets))
+        self.targets = targets
+        self.cache.prune(targets)
+        self.update_views(time.monotonic())
+        self.rotation = 0
+        # A new station always wins over whatever incidents are up.
+        # Put whatever we have for it on the panel now rather than
+        # leaving an incident page up until the fetch comes back.
+        if self.playback.active:
+            self.playback.stop()
+            self.draw_board()
+        self.playback_changed.set()
+        self.force_update = True
+        self.poll_now.set()
+
+    async def poll_predictions(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.poll_now.clear()
+            if self.logs != None:
+                # Pick up log levels changed through the API
+                self.logs.apply_levels()
+            await asyncio.sleep(self.budget.delay())
+            targets = self.targets
+            version = self.control_version
+            cycle_start = time.monotonic()
+            boards = await loop.run_in_executor(None, get_boards, self.api_key, targets)
+            if version != self.control_version:
+                # Changed while the request was out, poll_now is
+                # already set so go straight back for the new one
+                continue
+            self.show_train_times(boards)
+            display_metrics.observe("metro_poll_cycle_seconds", time.monotonic() - cycle_start)
+            targets_changed = self.applied_version != version
+            if targets_changed:
+                self.control.mark_applied(version, targets)
+                self.applied_version = version
+            await self.save_state(targets_changed)
+            delay = self.scheduler.next_delay(None if boards == None else [board.times() for board in boards])
+            await wait_for_event(self.poll_now, delay)
+
+    def show_train_times(self, boards):
+        force_update = self.force_update
+        self.force_update = False
+
+        now = time.monotonic()
+        if boards == None:
+            # Keep showing what we have, counted down, until it's fixed
+            log.error("Error getting update from WMATA API.")
+        else:
+            self.cache.update(self.targets, boards, now)
 
-    return lines, cars, dests, times
+        if self.update_views(now):
+            force_update = True
+        elif force_update:
+            log.debug("Times did not change but a display update was foced.")
+        else:
+            log.debug("No update")
+
+        # While incidents are playing we keep the latest times
+        # around and draw them once playback is done
+        if force_update and not self.playback.active:
+            self.draw_board()
+            if boards != None and not self.live:
+                log.info("First fetched times drawn {:.3f}s after start".format(time.monotonic() - self.started))
+                self.live = True
+            if self.change_started != None:
+                latency = time.monotonic() - self.change_started
+                log.info("Station change took {:.3f}s to reach the display".format(latency))
+                self.control.record_change_latency(latency)
+                self.change_started = None
+
+    def restore_boards(self):
+        # Boards saved before a restart, only if they're for what
+        # we're showing now. Nothing here touches the network so
+        # they can go on the panel before the first fetch.
+        if self.state == None or self.state.restored == None:
+            return
+        restored = self.state.restored
+        if [target_key(target) for target in restored.targets] != [target_key(target) for target in self.targets]:
+            return
+        # Saved times are wall clock, the cache runs on monotonic
+        now = time.monotonic()
+        wall_now = time.time()
+        boards = [(board, now - max(0, wall_now - fetched_at)) for board, fetched_at in restored.boards]
+        self.cache.restore(self.targets, boards)
+        self.update_views(now)
+
+    async def save_state(self, targets_changed):
+        now = time.monotonic()
+        if self.state == None:
+            return
+        if not targets_changed and self.saved_at != None and now - self.saved_at < STATE_SAVE_SECONDS:
+            return
+
+        wall_now = time.time()
+        boards = []
+        for target in self.targets:
+            fetched = self.cache.fetched(target)
+            if fetched == None:
+                # Save the targets now and the boards once they're all here
+                boards = []
+                break
+            board, fetched_at = fetched
+            boards.append((board, wall_now - (now - fetched_at)))
 
-def run_display(api_key, station_code_receiver, direction_receiver, font_file):
-    #global station_code
+        try:
+            # fsync can be slow on an SD card, keep it off the loop
+            await asyncio.get_running_loop().run_in_executor(None, self.state.save, self.targets, boards)
+        except OSError as e:
+            log.warning("Could not save state to {}: {}".format(self.state.path, e))
+            return
+        # Until the boards for these targets are saved too,
+        # try again on every poll instead of waiting a minute
+        self.saved_at = now if len(boards) == len(self.targets) else None
+
+    def update_views(self, now):
+        # Returns True if the panel should change. Boards carry their
+        # own hash so the compare is cheap when they differ.
+        views = [self.cache.view(target, now) for target in self.targets]
+        boards = tuple(board for board, stale in views)
+        stale = tuple(stale for board, stale in views)
+        if boards == self.boards and stale == self.stale:
+            return False
+        self.boards = boards
+        self.stale = stale
+        return True
+
+    async def count_down(self):
+        # Between polls, and while WMATA is unreachable, move the
+        # times along as each minute since the last fetch passes
+        while True:
+            await asyncio.sleep(self.cache.next_change(self.targets, time.monotonic()))
+            if self.update_views(time.monotonic()) and not self.playback.active:
+                self.draw_board()
+
+    def tiles(self):
+        return max(1, self.renderer.width // BOARD_WIDTH)
+
+    def draw_board(self):
+        if len(self.boards) <= self.tiles():
+            draw_boards(self.renderer, self.font_file, self.boards, self.stale)
+        else:
+            draw_boards(self.renderer, self.font_file, (self.boards[self.rotation],), (self.stale[self.rotation],))
+
+    async def rotate_boards(self):
+        while True:
+            await asyncio.sleep(TARGET_ROTATE_SECONDS)
+            if len(self.boards) <= self.tiles():
+                continue
+            self.rotation = (self.rotation + 1) % len(self.boards)
+            if not self.playback.active:
+                self.draw_board()
+
+    async def poll_incidents(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(INCIDENT_CHECK_SECONDS)
+            await asyncio.sleep(self.budget.delay())
+            incidents = await loop.run_in_executor(None, fetch_incidents, self.api_key)
+            if incidents != None:
+                self.incident_store.update(incidents)
+
+            # Anything due while incidents are still playing
+            # gets picked up on the next check
+            if self.playback.active:
+                continue
+
+            line_codes = set()
+            for target in self.targets:
+                station = get_station_by_code(target.station_code)
+                if station == None:
+                    log.error("Could not find station for code: {}".format(target.station_code))
+                    continue
+                line_codes.update(target.lines if target.lines != None else get_line_codes_from_station(station))
+            self.playback.start(self.incident_store.due_messages(line_codes, time.monotonic()), time.monotonic())
+            self.playback_changed.set()
+
+    async def play_incidents(self):
+        while True:
+            self.playback_changed.clear()
+            timeout = None
+            if self.playback.active:
+                now = time.monotonic()
+                if self.playback.step(now):
+                    self.draw_board()
+                else:
+                    timeout = max(0, self.playback.next_deadline() - now)
+            await wait_for_event(self.playback_changed, timeout)
 
-    # station code and direction will be sent on init
-    station_code = station_code_receiver.recv()
-    direction = direction_receiver.recv()
-    incidents_check_count = 0
-    canvas = init_matrix()
-    logging.info("RUNNING PROGRAM")
+def run_display(api_key, control, font_file, logs=None, state=None, started=None):
+    renderer = FrameRenderer(init_matrix())
+    log.info("RUNNING PROGRAM")
 
-    prev_lines = []
-    prev_cars = []
-    prev_dests = []
-    prev_times = []
+    if WMATA_PROXY:
+        # Read through our own proxy like the other signs do, so this
+        # sign shares its cache and its request budget with them
+        set_default_base_url("http://127.0.0.1:{}".format(API_PORT))
+        log.info("Getting times through the proxy on port {}".format(API_PORT))
 
-    draw_display(canvas, font_file, [], [], [], [])
+    display = DisplayLoop(api_key, font_file, renderer, control, logs, state, started)
+    asyncio.run(display.run())
 
-    while True:
-        force_update = False
-        if station_code_receiver.poll():
-            station_code = station_code_receiver.recv()
-        if direction_receiver.poll():
-            direction = direction_receiver.recv()
-        if incidents_check_count == 12: # check for incidents every minute
-            force_update = True
-            station = get_station_by_code(station_code)
-            if station == None:
-                logging.error("Could not find station for code: {}", station_code)
-            line_codes = get_line_codes_from_station(station)
-            incidents = get_incidents(line_codes, api_key)
-            for incident in incidents:
-                logging.info("Calling draw_incident for: {}".format(incident))
-                draw_incident(canvas, font_file, incident)
-            incidents_check_count = 0
-
-        prev_lines, prev_cars, prev_dests, prev_times = show_train_times(api_key, font_file, canvas, station_code, direction, prev_lines, prev_cars, prev_dests, prev_times, force_update)
-        
-        time.sleep(5)
-        incidents_check_count += 1
+def read_control(control):
+    version, targets = control.read()
+    return version, [Target(*target) for target in targets]
 
 def init_matrix():
     options = RGBMatrixOptions()
@@ -119,223 +392,311 @@ def init_matrix():
     return RGBMatrix(options = options)
 
 def get_train_data(api_key, station_code, direction):
-    headers = {"api_key":api_key, "Accept":"application/json"}
+    boards = get_boards(api_key, [Target(station_code, direction, None)])
+    if boards == None:
+        return None
+    return boards[0]
+
+def get_boards(api_key, targets):
+    start = time.monotonic()
+    boards = request_boards(api_key, targets)
+    display_metrics.observe("metro_wmata_request_seconds", time.monotonic() - start, "GetPrediction")
+    display_metrics.inc("metro_wmata_requests_total", "GetPrediction")
+    if boards == None:
+        display_metrics.inc("metro_wmata_failures_total", "GetPrediction")
+    else:
+        display_metrics.touch("metro_prediction_age_seconds")
+    return boards
+
+def request_boards(api_key, targets):
+    # Every target is fetched with a single request,
+    # GetPrediction takes a comma separated list of codes
+    station_codes = []
+    for target in targets:
+        if target.station_code not in station_codes:
+            station_codes.append(target.station_code)
 
     try:
-        resp = requests.get("https://api.wmata.com/StationPrediction.svc/json/GetPrediction/" + station_code, headers=headers)
+        resp = get_client(api_key).get_prediction(",".join(station_codes))
     except Exception:
         tb = traceback.format_exc()
         traceback.print_exc()
-        logging.error("An error occured while getting train data:")
-        logging.error(tb)
-        return None, None, None, None
-
-    lines = []
-    cars = []
-    dests = []
-    times = []
+        log.error("An error occured while getting train data:")
+        log.error(tb)
+        return None
 
     if resp.status_code != 200:
-        logging.error("Error getting train data! Response status code: ", resp.status_code)
-    else:
-        try:
-            resp_json = resp.json()
-
-            logging.debug("GOT RESPONSE!!")
-
-            for train in resp_json['Trains']:
-                if train['Group'] == direction:
-                    car = parse_value(train['Car'])
-                    dest = parse_value(train['Destination'])
-                    line = parse_value(train['Line'])
-                    time = parse_value(train['Min'])
-                    lines.append(line)
-                    cars.append(car)
-                    dests.append(dest)
-                    times.append(time)
-
-            # If there are no trains in our group, we need to see if they're on the other
-            # platform for single tracking
-            if len(lines) == 0 and len(cars) == 0 and len(dests) == 0 and len(times) == 0:
-                # Using the terminal station names which we can get from the codes
-                # we can see if there are any trains going to our destination on the other
-                # pltform
-                station = get_station_by_code(station_code)
-                terminals = get_line_terminals(station, direction)
-                trains_on_opposite_platform = []
-                for train in resp_json['Trains']:
-                    for terminal in terminals:
-                        if terminal == sanitize_input(parse_value(train['DestinationName'])):
-                            trains_on_opposite_platform.append(train)
-
-                # If there are trains for our destination on the other
-                # platform, switch the direction and recreate our trains
-                # to be displayed
-                new_direction = "1"
-                if len(trains_on_opposite_platform) > 0:
-                    if direction == "1":
-                        new_direction = "2"
-                    for train in resp_json['Trains']:
-                        if train['Group'] == new_direction:
-                            car = parse_value(train['Car'])
-                            dest = parse_value(train['Destination'])
-                            line = parse_value(train['Line'])
-                            time = parse_value(train['Min'])
-                            lines.append(line)
-                            cars.append(car)
-                            dests.append(dest)
-                            times.append(time)
-
-
-        except ValueError:
-            tb = traceback.format_exc()
-            traceback.print_exc()
-            logging.error("Received value error, invalid JSON.")
-            logging.error(tb)
-
-    return lines, cars, dests, times
-
-def draw_display(canvas, font_file, lines, cars, dests, mins):
-    height_delta = 8
-    width_delta = 6
+        log.error("Error getting train data! Response status code: {}".format(resp.status_code))
+        return None
 
-    total_width = 128
-
-    font = graphics.Font()
-    font.LoadFont(font_file)
-    red_color = graphics.Color(255,0,0)
-    yellow_color = graphics.Color(200,125,0)
-    green_color = graphics.Color(50,150,0)
-
-    canvas.Clear()
-    graphics.DrawText(canvas, font, 0, 7, red_color, "LN CAR  DEST")
-    graphics.DrawText(canvas, font, 111, 7, red_color, "MIN")
-
-    i = 0
-    for line in lines:
-        graphics.DrawText(canvas, font, 0, 15 + i*height_delta, yellow_color, line)
-        i += 1
-
-    i = 0
-    for car in cars:
-        # Handle case for No Passenger trains
-        if lines[i] == "No" and car == "":
-            graphics.DrawText(canvas, font, 28, 15 + i*height_delta, yellow_color, "Pa")
-        elif car == "8": # 8 car trains are green
-            graphics.DrawText(canvas, font, 20, 15 + i*height_delta, green_color, car)
-        else:
-            graphics.DrawText(canvas, font, 20, 15 + i*height_delta, yellow_color, car)
-        i += 1
+    try:
+        trains = resp.json()['Trains']
+    except ValueError:
+        tb = traceback.format_exc()
+        traceback.print_exc()
+        log.error("Received value error, invalid JSON.")
+        log.error(tb)
+        return None
+
+    log.debug("GOT RESPONSE!!")
+
+    # One pass turns every prediction into a Train on its station
+    # and platform, and notes where each station's trains are headed
+    by_platform = {}
+    destinations = {}
+    for prediction in trains:
+        by_platform.setdefault((prediction['LocationCode'], prediction['Group']), []).append(train_from_prediction(prediction))
+        destinations.setdefault(prediction['LocationCode'], set()).add(sanitize_input(parse_value(prediction['DestinationName'])))
+
+    return tuple(target_board(target, by_platform, destinations) for target in targets)
+
+def target_board(target, by_platform, destinations):
+    station_code, direction, lines = target
+    trains = on_lines(by_platform.get((station_code, direction), []), lines)
+
+    # If there are no trains in our group, we need to see if they're on the other
+    # platform for single tracking
+    if len(trains) == 0:
+        # Using the terminal station names which we can get from the codes
+        # we can see if there are any trains going to our destination on the other
+        # pltform
+        station = get_station_by_code(station_code)
+        terminals = get_line_terminals(station, direction, lines) if station != None else []
 
-    i = 0
-    for dest in dests:
-        graphics.DrawText(canvas, font, 40, 15 + i*height_delta, yellow_color, dest)
-        i += 1
+        # If there are trains for our destination on the other
+        # platform, switch the direction and use those instead
+        if not destinations.get(station_code, set()).isdisjoint(terminals):
+            new_direction = "1"
+            if direction == "1":
+                new_direction = "2"
+            trains = on_lines(by_platform.get((station_code, new_direction), []), lines)
 
-    i = 0
-    for time in mins:
-        x = total_width - len(time)*width_delta + 1 # Add one to account for space at end
-        graphics.DrawText(canvas, font, x, 15 + i*height_delta, yellow_color, time)
-        i += 1
+    return Board(trains)
 
-def parse_value(value):
-    return value if value != None else ""
+def on_lines(trains, lines):
+    if lines == None:
+        return trains
+    return [train for train in trains if train.line in lines]
 
-def serve(init_station_code, init_direction, station_code_sender, direction_sender):
-    with app.app_context():
-        current_app.station_code = init_station_code
-        current_app.direction = init_direction
-        current_app.station_code_sender = station_code_sender
-        current_app.direction_sender = direction_sender
-    app.run(host="0.0.0.0")
+def draw_display(renderer, font_file, board):
+    draw_boards(renderer, font_file, (board,))
 
+def draw_boards(renderer, font_file, boards, stale=None):
+    width_delta = 6
 
+    total_width = BOARD_WIDTH
+
+    font = get_font(font_file)
+    red_color = get_color("red")
+    yellow_color = get_color("yellow")
+    green_color = get_color("green")
+
+    # Boards sit side by side, one every 128 pixels. Row 0 is the
+    # header, every other row holds one train from each board. Rows
+    # that are the same as what's already on the panel won't be redrawn.
+    if stale == None:
+        stale = tuple(False for board in boards)
+    rows = [Header(tuple(stale))]
+    for i in range(max(len(board) for board in boards)):
+        rows.append(tuple(board[i] if i < len(board) else None for board in boards))
+
+    def draw_row(canvas, y, row):
+        for tile in range(len(boards)):
+            left = tile * total_width
+            if isinstance(row, Header):
+                graphics.DrawText(canvas, font, left, y, red_color, "LN CAR  DEST")
+                if row.stale[tile]:
+                    # Times are being counted down from an old fetch
+                    graphics.DrawText(canvas, font, left + 78, y, yellow_color, "STALE")
+                graphics.DrawText(canvas, font, left + 111, y, red_color, "MIN")
+                continue
+            if row[tile] == None:
+                continue
+
+            line, car, dest, time = row[tile]
+            graphics.DrawText(canvas, font, left, y, yellow_color, line)
+
+            # Handle case for No Passenger trains
+            if line == "No" and car == "":
+                graphics.DrawText(canvas, font, left + 28, y, yellow_color, "Pa")
+            elif car == "8": # 8 car trains are green
+                graphics.DrawText(canvas, font, left + 20, y, green_color, car)
+            else:
+                graphics.DrawText(canvas, font, left + 20, y, yellow_color, car)
+
+            graphics.DrawText(canvas, font, left + 40, y, yellow_color, dest)
+
+            x = left + total_width - len(time)*width_delta + 1 # Add one to account for space at end
+            graphics.DrawText(canvas, font, x, y, yellow_color, time)
+
+    start = time.monotonic()
+    if renderer.update_rows(rows, draw_row):
+        display_metrics.observe("metro_frame_render_seconds", time.monotonic() - start, "board")
+
+def serve(control, logs=None, api_key=None):
+    with app.app_context():
+        current_app.control = control
+        current_app.logs = logs
+        # Other signs can point WMATA_BASE_URL here and share our requests
+        current_app.proxy = None
+        if WMATA_PROXY and api_key != None:
+            api_log.info("Proxying WMATA requests for other signs")
+            current_app.proxy = WMATAProxy(api_key)
+
+    if API_SERVER == "waitress":
+        # Only imported in this mode so the dev server doesn't load it
+        from waitress import serve as waitress_serve
+        api_log.info("Serving API with waitress ({} threads)".format(API_THREADS))
+        waitress_serve(app, host="0.0.0.0", port=API_PORT,
+                       threads=API_THREADS,
+                       channel_timeout=API_TIMEOUT_SECONDS)
+    else:
+        app.run(host="0.0.0.0", port=API_PORT)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.monotonic()
+
+@app.after_request
+def record_latency(response):
+    start = g.get('request_start')
+    if start != None:
+        route = request.url_rule.rule if request.url_rule != None else "unmatched"
+        route_latency.record("{} {}".format(request.method, route), time.monotonic() - start)
+    return response
+
+@app.route('/stats/routes')
+def get_route_stats():
+    return jsonify(**route_latency.summary()), 200
+
+# Recent log records from both processes, oldest first. These
+# include records below the level that gets written to the log file.
+@app.route('/logs')
+def get_logs():
+    logs = getattr(current_app, 'logs', None)
+    if logs == None:
+        not_running = {
+            'error': "Logging pipeline is not running"
+        }
+        return jsonify(**not_running), 503
 
-def convert_line(line):
-    global lines_file
-    with open(lines_file.value) as lf:
-        lines_json = json.load(lf)
-        for existing_line in lines_json['Lines']:
-            logging.debug("Input line: {}, compared to: {}".format(line, existing_line['DisplayName']))
-            if sanitize_input(line) == existing_line['DisplayName']:
-                logging.debug("Matched! Returning {}".format(existing_line['LineCode']))
-                return existing_line['LineCode']
+    level = request.args.get('level', 'NOTSET').upper()
+    min_level = logging.getLevelName(level)
+    if not isinstance(min_level, int):
+        bad_level = {
+            'error': "Unknown log level '{}'".format(request.args.get('level'))
+        }
+        return jsonify(**bad_level), 400
 
-    return None
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        bad_limit = {
+            'error': "Could not parse limit '{}'".format(request.args.get('limit'))
+        }
+        return jsonify(**bad_limit), 400
+
+    return jsonify(records=logs.recent(limit, min_level)), 200
+
+# Logger levels by name, e.g. {"incidents": "DEBUG"}. A PUT replaces
+# all of them, loggers left out go back to the default level.
+@app.route('/logs/levels', methods=['GET', 'PUT'])
+def log_levels():
+    logs = getattr(current_app, 'logs', None)
+    if logs == None:
+        not_running = {
+            'error': "Logging pipeline is not running"
+        }
+        return jsonify(**not_running), 503
 
-def get_station_by_code(code):
-    global stations_file
-    with open(stations_file.value) as sf:
-        stations = json.load(sf)
-        for station in stations['Stations']:
-            if station['Code'] == code:
-                return station
+    if request.method == 'PUT':
+        levels = request.get_json(force=True)
+        if not isinstance(levels, dict):
+            bad_levels = {
+                'error': "Expected an object of logger names to levels"
+            }
+            return jsonify(**bad_levels), 400
+        try:
+            logs.set_levels(levels)
+        except ValueError as e:
+            bad_levels = {
+                'error': str(e)
+            }
+            return jsonify(**bad_levels), 400
+
+    return jsonify(levels=logs.levels()), 200
+
+@app.route('/metrics')
+def get_metrics():
+    # Prometheus text format, recorded by the display process
+    return display_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# The same paths as WMATA's API so another sign only has to
+# change WMATA_BASE_URL. Whatever api_key it sends is ignored.
+@app.route('/StationPrediction.svc/json/GetPrediction/<station_codes>')
+def proxy_prediction(station_codes):
+    proxy = getattr(current_app, 'proxy', None)
+    if proxy == None:
+        return proxy_disabled()
+    return proxy.get_prediction(station_codes)
+
+@app.route('/Incidents.svc/json/Incidents')
+def proxy_incidents():
+    proxy = getattr(current_app, 'proxy', None)
+    if proxy == None:
+        return proxy_disabled()
+    return proxy.get_incidents()
+
+def proxy_disabled():
+    disabled = {
+        'error': "Proxy mode is not enabled on this sign"
+    }
+    return jsonify(**disabled), 404
 
-    return None
 
-def get_station_by_name(station_name, station_lines=None):
-    global stations_file
-    with open(stations_file.value) as sf:
-        stations = json.load(sf)
-        for station in stations['Stations']:
-            if station_name in station['Name']:
-                if station_lines == None:
-                    return station
-                elif matching_lines(station, station_lines) > 0:
-                    return station
-    return None
 
-def parse_direction(direction, line):
-    if direction == "1":
-        code = line["EndStationCode"]
-    else:
-        code = line["StartStationCode"]
+def registry():
+    return get_registry(stations_file.value, lines_file.value)
 
-    station = get_station_by_code(code)
+def convert_line(line):
+    line_code = registry().line_code_by_name(line)
+    if line_code != None:
+        api_log.debug("Matched {}! Returning {}".format(line, line_code))
+    return line_code
 
-    if station != None:
-        return station['Name']
-    else:
-        return ''
+def get_station_by_code(code):
+    return registry().station_by_code(code)
+
+def get_station_by_name(station_name, station_lines=None):
+    return registry().station_by_name(station_name, station_lines)
 
 def search_lines(line_code, direction):
-    global lines_file
-    with open(lines_file.value) as lf:
-        lines_json = json.load(lf)
-        for line in lines_json['Lines']:
-            if line['LineCode'] == line_code:
-                return parse_direction(direction, line)
+    return registry().line_terminal(line_code, direction)
 
 def get_direction_from_terminal(station_name, station_lines):
-    global lines_file
     station = get_station_by_name(station_name, station_lines)
     if station != None:
-        logging.debug("Name: {} Code: {}".format(station['Name'], station['Code']))
-        with open(lines_file.value) as lf:
-            lines_json = json.load(lf)
-            for line in lines_json['Lines']:
-                if line['LineCode'] == "YL":
-                    logging.debug("Start: {} End: {}".format(line['StartStationCode'], line['EndStationCode']))
-                if station['Code'] == line['StartStationCode']:
-                    return "2"
-                elif station['Code'] == line['EndStationCode']:
-                    return "1"
-    logging.debug("Station is None.")
+        api_log.debug("Name: {} Code: {}".format(station['Name'], station['Code']))
+        direction = registry().direction_to_terminal(station['Code'])
+        if direction != None:
+            return direction
+    api_log.debug("Station is None.")
     return None
 
 def get_line_terminals(station, direction, lines=None):
-    terminals = []
-
     # If the user hasn't specified (a) line(s)
-    # get all of the lines that run through the
-    # station
+    # the terminals for every line that runs through
+    # the station are already in the registry
     if lines == None:
-        lines = get_line_codes_from_station(station)
+        return registry().station_terminals(station['Code'], direction)
 
+    terminals = []
     for line_code in lines:
-        terminals.append(search_lines(line_code, direction))
+        terminal = search_lines(line_code, direction)
+        if terminal not in terminals: # some lines have the same terminal station
+            terminals.append(terminal)
 
-    return list(set(terminals)) # Remove duplicates from the set (some lines have the same terminal station)
+    return terminals
 
 def matching_lines(station, station_lines):
     if station_lines == None or station == None:
@@ -353,50 +714,27 @@ def matching_lines(station, station_lines):
     return len(intersection)
 
 def get_line_codes_from_station(station):
-    lines = []
-
-    # There are 4 possible line codes per
-    # station. Each formatted as LineCodeX
-    # where x is an integer. Grab the line
-    # codes and return a list
-    for x in range(1,5):
-        line_code = station['LineCode{}'.format(x)]
-        if line_code != None and line_code != "":
-            lines.append(line_code)
-
-    return lines
-
-
-# Since there's no utils file (yet) make sure to
-# update this everywhere there is one.
-def sanitize_input(station_name):
-    station_name = station_name.replace("/", " ")
-    station_name = station_name.replace("-", " ")
-    station_name = station_name.replace("'", "")
-    station_name = station_name.lower()
-
-    return station_name
+    return station_line_codes(station)
 
 
 def respond_success(station, lines=None, direction=None):
-    logging.debug("Updating station to: {} with code {}.".format(station['Name'], station['Code']))
+    api_log.debug("Updating station to: {} with code {}.".format(station['Name'], station['Code']))
 
     with current_app.app_context():
-        station_code = station['Code']
-        if station_code != current_app.station_code:
-            current_app.station_code = station_code
-            station_code_sender = current_app.station_code_sender
-            station_code_sender.send(station_code)
+        control = current_app.control
+
+    version, targets = read_control(control)
 
     # if a new direction is submitted, change the direction
     # otherwise, use the current direction
-    with current_app.app_context():
-        if direction != None:
-            current_app.direction = direction
-            direction_sender = current_app.direction_sender
-            direction_sender.send(direction)
-        else:
-            direction = current_app.direction
+    if direction == None:
+        direction = targets[0].direction
+
+    # Station, direction and lines go over as one record
+    # so the display never shows half of a change
+    target = Target(station['Code'], direction, lines)
+    if targets != [target]:
+        control.publish([target])
 
     terminals = get_line_terminals(station, direction, lines)
 
@@ -410,7 +748,6 @@ def respond_success(station, lines=None, direction=None):
 
 @app.route('/station/name', methods=['PUT'])
 def change_station_by_name():
-    global stations_file
     req = request.get_json(force=True)
     station_name = req['stationName']
     station_lines = None
@@ -467,44 +804,41 @@ def change_station_by_name():
             return jsonify(**bad_station), 400
         terminal_station = sanitize_input(terminal_station)
     
-    # Look inside cached stations file for the station name
-    # and save the associated code
-    with open(stations_file.value) as sf:
-        stations = json.load(sf)
-        for station in stations['Stations']:
-            # Use 'in' operator because of stations like
-            # 'foggy bottom gwu' and 'ballston mu' where
-            # someone would either use one half of the name
-            # or the other
-            if station_name in station['Name']:
-                if station_lines != None and terminal_station != None:
-                    optional_direction = get_direction_from_terminal(terminal_station, station_lines)
-                    logging.debug("DIRECTION: {}".format(optional_direction))
-                    if optional_direction != None and matching_lines(station, station_lines) == len(station_lines):
-                        return respond_success(station, station_lines, optional_direction)
-                elif station_lines != None:
-                    if matching_lines(station, station_lines) == len(station_lines):
-                        return respond_success(station, station_lines)
-                elif terminal_station != None:
-                    # Need to pass the lines of the station
-                    # to the get_direction_from_terminal due to
-                    # edge case at Fort Totten. This station is the
-                    # terminal of the Yellow line but it is also a Red
-                    # line station. As a result if we search for the station
-                    # by name, we must specify the line we want.
-                    lines = get_line_codes_from_station(station)
-                    logging.debug(lines)
-                    optional_direction = get_direction_from_terminal(terminal_station, lines)
-                    logging.debug("DIRECTION: {}".format(optional_direction))
-                    if optional_direction != None:
-                        return respond_success(station, station_lines, optional_direction)
-                elif station['StationTogether1'] != "" or station['StationTogether2'] != "":
-                    need_line = {
-                        'error': ("Multiple platforms: must specify line(s) for '{}'").format(station_name)
-                    }
-                    return jsonify(**need_line), 400
-                else:
-                    return respond_success(station)
+    # Best matches first. Words can be prefixes, and in any order,
+    # because of stations like 'foggy bottom gwu' and 'ballston mu'
+    # where someone would either use one half of the name or the other
+    line_direction = None
+    if station_lines != None and terminal_station != None:
+        line_direction = get_direction_from_terminal(terminal_station, station_lines)
+        api_log.debug("DIRECTION: {}".format(line_direction))
+
+    for station in registry().search_stations(station_name):
+        if station_lines != None and terminal_station != None:
+            if line_direction != None and matching_lines(station, station_lines) == len(station_lines):
+                return respond_success(station, station_lines, line_direction)
+        elif station_lines != None:
+            if matching_lines(station, station_lines) == len(station_lines):
+                return respond_success(station, station_lines)
+        elif terminal_station != None:
+            # Need to pass the lines of the station
+            # to the get_direction_from_terminal due to
+            # edge case at Fort Totten. This station is the
+            # terminal of the Yellow line but it is also a Red
+            # line station. As a result if we search for the station
+            # by name, we must specify the line we want.
+            lines = get_line_codes_from_station(station)
+            api_log.debug(lines)
+            optional_direction = get_direction_from_terminal(terminal_station, lines)
+            api_log.debug("DIRECTION: {}".format(optional_direction))
+            if optional_direction != None:
+                return respond_success(station, station_lines, optional_direction)
+        elif station['StationTogether1'] != "" or station['StationTogether2'] != "":
+            need_line = {
+                'error': ("Multiple platforms: must specify line(s) for '{}'").format(station_name)
+            }
+            return jsonify(**need_line), 400
+        else:
+            return respond_success(station)
 
     not_found_message = "Could not find station with name '{}'".format(req['stationName'])
 
@@ -520,26 +854,67 @@ def change_station_by_name():
     return jsonify(**not_found), 404
 
 
+# Ranked matches for autocomplete, each with the
+# terminals for both directions
+@app.route('/stations/search')
+def search_stations():
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        bad_limit = {
+            'error': "Could not parse limit '{}'".format(request.args.get('limit'))
+        }
+        return jsonify(**bad_limit), 400
+    if limit < 1:
+        bad_limit = {
+            'error': "limit must be at least 1, got {}".format(limit)
+        }
+        return jsonify(**bad_limit), 400
+
+    results = []
+    for station in registry().search_stations(query, limit):
+        results.append({
+            "stationName": station['Name'],
+            "code": station['Code'],
+            "lines": get_line_codes_from_station(station),
+            "directions": {
+                "1": get_line_terminals(station, "1"),
+                "2": get_line_terminals(station, "2")
+            }
+        })
+
+    return jsonify(results=results), 200
+
+
 @app.route('/state')
 def get_state():
-    station = None
-
     with current_app.app_context():
-        station_code = current_app.station_code
-        station = get_station_by_code(station_code)
-        if station == None:
-            err_json = {
-                'error': "Could not find station for code {}".format(station_code)
-            }
-            return jsonify(**err_json), 500
+        control = current_app.control
+
+    # Report what the display is actually showing, which can lag
+    # behind the last change while the new times are downloaded
+    applied_version, targets = control.applied()
+    if targets == None:
+        # Nothing on the panel yet, describe what's been asked for
+        targets = control.read()[1]
+    target = Target(*targets[0])
 
+    station = get_station_by_code(target.station_code)
     if station == None:
         err_json = {
-                'error': "Failed to get station from context"
-            }
+            'error': "Could not find station for code {}".format(target.station_code)
+        }
         return jsonify(**err_json), 500
 
-    return respond_success(station)
+    state_json = {
+        "stationName": station['Name'],
+        "directions": get_line_terminals(station, target.direction, target.lines),
+        "pending": applied_version == 0 or control.version() != applied_version,
+        "changeLatencySeconds": control.change_latency()
+    }
+
+    return jsonify(**state_json), 202
 
 
 def main():
@@ -550,31 +925,51 @@ def main():
         print("Usage rpi-metro-display <log_file> <api_key> <initial_station_code> <initial_direction_code> <font_file> <lines_file> <stations_file>")
         sys.exit(2)
 
+    started = time.monotonic()
+
     sys.excepthook = exception_hook
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    #logging.basicConfig(filename='/home/pi/matrix-text-test/app.log',level=logging.DEBUG)
-    handler = TimedRotatingFileHandler(sys.argv[1],
-                                       when="d",
-                                       interval=1,
-                                       backupCount=5)
-    #sys_log_handler = SysLogHandler('/dev/log')
-
-
-    logger.addHandler(handler)
-    #logger.addHandler(sys_log_handler)
-
-    station_code_receiver, station_code_sender = Pipe()
-    station_code_sender.send(sys.argv[3])
-    direction_receiver, direction_sender = Pipe()
-    direction_sender.send(sys.argv[4])
+    # Both processes log through a queue to a writer thread
+    # here, which is the only thing that touches the log file
+    logs = LogPipeline(sys.argv[1])
+    logs.start()
+
+    # Pick up the station from before a restart, if run.sh
+    # still asks for the same one it did back then
+    state = StateFile(STATE_FILE, sys.argv[3:5])
+    restored = state.load()
+    control = ControlBlock()
+    if restored != None:
+        try:
+            control.publish([Target(*target) for target in restored.targets])
+        except ValueError as e:
+            # Too big for the control block, start from run.sh instead
+            log.warning("Could not use saved state: {}".format(e))
+            state.restored = None
+    if state.restored == None:
+        control.publish(parse_targets(sys.argv[3], sys.argv[4]))
     lines_file = Value(ctypes.c_wchar_p, sys.argv[6])
     stations_file = Value(ctypes.c_wchar_p, sys.argv[7])
-    server = Process(target = serve, args=(sys.argv[3],sys.argv[4],station_code_sender,direction_sender,))
-    run_displays = Process(target = run_display, args=(sys.argv[2],station_code_receiver,direction_receiver,sys.argv[5],))
+
+    # Load the transit data before forking so both processes start
+    # with it, and so a stale or corrupt snapshot stops us here
+    try:
+        registry()
+    except SnapshotError as e:
+        log.error(str(e))
+        print(e)
+        logs.stop()
+        sys.exit(1)
+
+    server = Process(target = serve, args=(control,logs,sys.argv[2],))
+    run_displays = Process(target = run_display, args=(sys.argv[2],control,sys.argv[5],logs,state,started,))
     server.start()
     run_displays.start()
 
+    # Keep the log writer going for as long as the children run
+    server.join()
+    run_displays.join()
+    logs.stop()
+
 if __name__ == '__main__':
     main()
 
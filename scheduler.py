@@ -0,0 +1,122 @@
+# Decides how often to ask WMATA for new train times
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from collections import deque
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import display_metrics
+
+log = logging.getLogger(__name__)
+
+FAST_POLL_SECONDS = 3
+NORMAL_POLL_SECONDS = 5
+SLOW_POLL_SECONDS = 15
+MAX_BACKOFF_SECONDS = 120
+
+# A head train at least this many minutes out gets the slow rate
+SLOW_POLL_MINUTES = 10
+
+# WMATA's default tier allows 50,000 calls a day, a bit under
+# 35 a minute. This budget covers predictions and incidents together.
+REQUESTS_PER_MINUTE = int(os.environ.get("WMATA_REQUESTS_PER_MINUTE", 30))
+
+class RequestBudget:
+    # Every HTTP request to WMATA is recorded here by the client,
+    # retries included, from whichever thread made it. name is who's
+    # making them, "display" or "proxy", for the log and /metrics.
+    def __init__(self, per_minute=REQUESTS_PER_MINUTE, clock=time.monotonic, name="display"):
+        self.per_minute = per_minute
+        self.name = name
+        self.clock = clock
+        self._window = deque()
+        self._lock = threading.Lock()
+        self._minute = None
+        self._minute_count = 0
+
+    def record(self):
+        with self._lock:
+            now = self.clock()
+            self._window.append(now)
+
+            minute = int(time.time() // 60)
+            if minute != self._minute:
+                if self._minute != None:
+                    log.info("WMATA requests last minute ({}): {}".format(self.name, self._minute_count))
+                self._minute = minute
+                self._minute_count = 0
+            self._minute_count += 1
+        self.requests_last_minute()
+
+    def delay(self):
+        # Seconds until another request fits in the last 60 seconds
+        with self._lock:
+            now = self.clock()
+            while len(self._window) > 0 and now - self._window[0] >= 60:
+                self._window.popleft()
+            if len(self._window) < self.per_minute:
+                return 0
+            return 60 - (now - self._window[0])
+
+    def requests_last_minute(self):
+        self.delay()
+        count = len(self._window)
+        display_metrics.set("metro_wmata_requests_last_minute", count, self.name)
+        return count
+
+
+class PollScheduler:
+    def __init__(self, budget):
+        self.budget = budget
+        self.errors = 0
+
+    def next_delay(self, boards):
+        # boards is a list of the times on each board,
+        # or None when the last poll failed
+        if boards == None:
+            self.errors += 1
+            delay = min(MAX_BACKOFF_SECONDS, NORMAL_POLL_SECONDS * (2 ** self.errors))
+            # Jitter so the API isn't hit on a fixed beat while it's struggling
+            delay = random.uniform(delay / 2, delay)
+            log.debug("Poll failed {} time(s), backing off {:.1f}s".format(self.errors, delay))
+        else:
+            self.errors = 0
+            # Whichever board is about to change sets the pace
+            delay = min((self.poll_interval(times) for times in boards), default=NORMAL_POLL_SECONDS)
+
+        return max(delay, self.budget.delay())
+
+    def poll_interval(self, times):
+        if len(times) == 0:
+            return NORMAL_POLL_SECONDS
+
+        head = times[0]
+        if head in ("ARR", "BRD"):
+            return FAST_POLL_SECONDS
+        try:
+            minutes = int(head)
+        except ValueError:
+            # "---" and blanks, nothing to go on
+            return NORMAL_POLL_SECONDS
+
+        if minutes <= 1:
+            return FAST_POLL_SECONDS
+        elif minutes >= SLOW_POLL_MINUTES:
+            return SLOW_POLL_SECONDS
+        return NORMAL_POLL_SECONDS
@@ -0,0 +1,176 @@
+# What a train and a board of trains look like on the sign
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from collections import namedtuple
+import os
+
+# Times older than this get a STALE marker on the panel
+PREDICTION_STALE_SECONDS = int(os.environ.get("PREDICTION_STALE_SECONDS", 90))
+
+# One row of a board, already turned into the strings that get
+# drawn. A namedtuple so it's small and compares like a tuple.
+Train = namedtuple('Train', ['line', 'car', 'dest', 'time'])
+
+
+def parse_value(value):
+    return value if value != None else ""
+
+
+def train_from_prediction(prediction):
+    return Train(parse_value(prediction['Line']),
+                 parse_value(prediction['Car']),
+                 parse_value(prediction['Destination']),
+                 parse_value(prediction['Min']))
+
+
+class Board:
+    # The trains for one target, in the order WMATA sent them.
+    # It never changes once built, so the hash is worked out up
+    # front and comparing two boards that differ is usually just
+    # comparing two ints.
+    __slots__ = ('trains', '_hash')
+
+    def __init__(self, trains=()):
+        object.__setattr__(self, 'trains', tuple(trains))
+        object.__setattr__(self, '_hash', hash(self.trains))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Board is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, Board):
+            return NotImplemented
+        return self._hash == other._hash and self.trains == other.trains
+
+    def __hash__(self):
+        return self._hash
+
+    def __len__(self):
+        return len(self.trains)
+
+    def __iter__(self):
+        return iter(self.trains)
+
+    def __getitem__(self, index):
+        return self.trains[index]
+
+    def __repr__(self):
+        return "Board({!r})".format(list(self.trains))
+
+    def times(self):
+        return [train.time for train in self.trains]
+
+
+EMPTY_BOARD = Board()
+
+
+def count_down(train, minutes_passed):
+    # Where a train should be now, going by its time when it was
+    # fetched. None means it must have left already.
+    if minutes_passed <= 0:
+        return train
+
+    if train.time == "BRD":
+        remaining = -1
+    elif train.time == "ARR":
+        remaining = 0
+    else:
+        try:
+            remaining = int(train.time)
+        except ValueError:
+            # "---" and blanks, nothing to count down
+            return train
+    remaining -= minutes_passed
+
+    if remaining < -1:
+        return None
+    elif remaining == -1:
+        time = "BRD"
+    elif remaining == 0:
+        time = "ARR"
+    else:
+        time = str(remaining)
+    return train._replace(time=time)
+
+
+class PredictionCache:
+    # The last good board for each target and when it was fetched.
+    # Between polls, or while WMATA is down, the times are counted
+    # down from that so the panel doesn't sit on old minutes.
+    def __init__(self, stale_seconds=PREDICTION_STALE_SECONDS):
+        self.stale_seconds = stale_seconds
+        self._boards = {}
+
+    def update(self, targets, boards, now):
+        for target, board in zip(targets, boards):
+            self._boards[target_key(target)] = (board, now, False)
+
+    def restore(self, targets, boards):
+        # boards are (board, monotonic time it was fetched) saved
+        # before a restart. They're shown as stale until a fetch
+        # works, however old they are.
+        for target, (board, fetched_at) in zip(targets, boards):
+            self._boards[target_key(target)] = (board, fetched_at, True)
+
+    def fetched(self, target):
+        # (board as it was fetched, when), None if there isn't one
+        cached = self._boards.get(target_key(target))
+        return cached[:2] if cached != None else None
+
+    def prune(self, targets):
+        # Forget targets that aren't on the sign anymore
+        keep = set(target_key(target) for target in targets)
+        for key in list(self._boards):
+            if key not in keep:
+                del self._boards[key]
+
+    def view(self, target, now):
+        # (board as it should look now, whether it's stale)
+        cached = self._boards.get(target_key(target))
+        if cached == None:
+            return EMPTY_BOARD, False
+
+        board, fetched_at, restored = cached
+        elapsed = now - fetched_at
+        minutes_passed = int(elapsed // 60)
+        if minutes_passed > 0:
+            trains = []
+            for train in board:
+                train = count_down(train, minutes_passed)
+                if train != None:
+                    trains.append(train)
+            board = Board(trains)
+        return board, restored or elapsed >= self.stale_seconds
+
+    def next_change(self, targets, now):
+        # Seconds until some view could look different, at most a minute
+        delay = 60
+        for target in targets:
+            cached = self._boards.get(target_key(target))
+            if cached == None:
+                continue
+            elapsed = now - cached[1]
+            delay = min(delay, 60 - elapsed % 60)
+            if elapsed < self.stale_seconds:
+                delay = min(delay, self.stale_seconds - elapsed)
+        return delay
+
+
+def target_key(target):
+    # Targets can carry a list of lines, which can't be a dict key
+    station_code, direction, lines = target
+    return station_code, direction, tuple(lines) if lines != None else None
+
@@ -0,0 +1,50 @@
+# Build the transit snapshot (stations, lines and lookup tables) in one file
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import sys
+from registry import write_snapshot, read_snapshot
+from utils import sanitize_input
+from wmata_client import get_client
+
+if len(sys.argv) != 3:
+    print("Usage updateTransitData.py <api_key> <output_file>")
+    sys.exit(2)
+
+api_key = sys.argv[1]
+output_file = sys.argv[2]
+client = get_client(api_key)
+
+stations_resp = client.get("/Rail.svc/json/jStations", "jStations")
+lines_resp = client.get("/Rail.svc/json/jLines", "jLines")
+if stations_resp.status_code != 200 or lines_resp.status_code != 200:
+    print("Error downloading stations ({}) or lines ({})".format(stations_resp.status_code, lines_resp.status_code))
+    sys.exit(1)
+
+stations = stations_resp.json()['Stations']
+lines = lines_resp.json()['Lines']
+
+# Sanitize the names the same way the display
+# sanitizes what it's asked to look up
+for station in stations:
+    station['Name'] = sanitize_input(station['Name'])
+for line in lines:
+    line['DisplayName'] = sanitize_input(line['DisplayName'])
+
+write_snapshot(output_file, stations, lines)
+
+# Make sure what we wrote is what the display will read
+header, data = read_snapshot(output_file)
+print("Wrote {} stations and {} lines to {}".format(len(data['Stations']), len(data['Lines']), output_file))
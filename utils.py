@@ -0,0 +1,27 @@
+# Shared helpers for rpi-metro-display
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Station and line names are stored sanitized in the
+# cached files, so anything compared against them has
+# to go through this first.
+def sanitize_input(station_name):
+    station_name = station_name.replace("/", " ")
+    station_name = station_name.replace("-", " ")
+    station_name = station_name.replace("'", "")
+    station_name = station_name.lower()
+
+    return station_name
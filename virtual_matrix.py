@@ -0,0 +1,290 @@
+# Stand-in for the rgbmatrix module that draws into memory instead of on a Pi
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import time
+import numpy as np
+
+# Only the parts of RGBMatrix, RGBMatrixOptions and graphics this
+# project uses, with the same names and arguments, so the rest of
+# the code can't tell the difference. Frames are kept as numpy
+# arrays (height x width x RGB) and can be saved as PNGs.
+
+
+class RGBMatrixOptions:
+    def __init__(self):
+        self.rows = 32
+        self.cols = 32
+        self.chain_length = 1
+        self.parallel = 1
+        self.pwm_bits = 11
+        self.pwm_lsb_nanoseconds = 130
+        self.gpio_slowdown = 1
+        self.brightness = 100
+        self.hardware_mapping = "regular"
+
+
+class FrameCanvas:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        self.draw_calls = 0
+        # Set by the first draw call after a swap so the matrix
+        # can tell how long the frame took to render
+        self.started = None
+
+    def _count(self):
+        if self.started == None:
+            self.started = time.perf_counter()
+        self.draw_calls += 1
+
+    def Clear(self):
+        self._count()
+        self.pixels[:] = 0
+
+    def Fill(self, red, green, blue):
+        self._count()
+        self.pixels[:] = (red, green, blue)
+
+    def SetPixel(self, x, y, red, green, blue):
+        self._count()
+        x = int(x)
+        y = int(y)
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.pixels[y, x] = (red, green, blue)
+
+    def SetImage(self, image, offset_x=0, offset_y=0, unsafe=True):
+        self._count()
+        self.blit(np.asarray(image.convert("RGB")), offset_x, offset_y)
+
+    def blit(self, src, x, y, mask=None):
+        # Copy src (h x w x 3) to (x, y), clipped to the canvas.
+        # With a mask only the pixels it marks are copied.
+        x = int(x)
+        y = int(y)
+        h, w = src.shape[:2]
+        left = max(0, -x)
+        top = max(0, -y)
+        right = min(w, self.width - x)
+        bottom = min(h, self.height - y)
+        if left >= right or top >= bottom:
+            return
+
+        target = self.pixels[y + top:y + bottom, x + left:x + right]
+        # numpy arrays can't be compared to None with ==
+        if mask is None:
+            target[:] = src[top:bottom, left:right]
+        else:
+            target[mask[top:bottom, left:right]] = src[top:bottom, left:right][mask[top:bottom, left:right]]
+
+    def to_image(self):
+        from PIL import Image
+        return Image.fromarray(self.pixels, "RGB")
+
+    def save_png(self, path, scale=1):
+        image = self.to_image()
+        if scale != 1:
+            from PIL import Image
+            image = image.resize((self.width * scale, self.height * scale), Image.NEAREST)
+        image.save(path, "PNG")
+
+
+class RGBMatrix:
+    def __init__(self, rows=None, chain=None, parallel=None, options=None):
+        if options == None:
+            options = RGBMatrixOptions()
+            if rows != None:
+                options.rows = rows
+            if chain != None:
+                options.chain_length = chain
+            if parallel != None:
+                options.parallel = parallel
+        self.options = options
+        self.width = options.cols * options.chain_length
+        self.height = options.rows * options.parallel
+
+        # What's "on the panel" right now
+        self.front = FrameCanvas(self.width, self.height)
+        self.frames = 0
+        # (draw calls, seconds from first draw call to swap) per frame
+        self.frame_stats = []
+
+    def CreateFrameCanvas(self):
+        return FrameCanvas(self.width, self.height)
+
+    def SwapOnVSync(self, canvas, framerate_fraction=1):
+        now = time.perf_counter()
+        render_seconds = now - canvas.started if canvas.started != None else 0.0
+        self.frame_stats.append((canvas.draw_calls, render_seconds))
+        self.frames += 1
+
+        canvas.draw_calls = 0
+        canvas.started = None
+        previous = self.front
+        self.front = canvas
+        return previous
+
+    def Clear(self):
+        self.front.Clear()
+
+    def SetImage(self, image, offset_x=0, offset_y=0, unsafe=True):
+        self.front.SetImage(image, offset_x, offset_y, unsafe)
+
+    def save_png(self, path, scale=1):
+        self.front.save_png(path, scale)
+
+    def reset_stats(self):
+        self.frames = 0
+        self.frame_stats = []
+
+
+class _Graphics:
+    # Mirrors rgbmatrix.graphics
+
+    class Color:
+        def __init__(self, red=0, green=0, blue=0):
+            self.red = red
+            self.green = green
+            self.blue = blue
+
+    class Font:
+        def __init__(self):
+            self.height = 0
+            self.baseline = 0
+            self._glyphs = {}
+
+        def LoadFont(self, path):
+            self._glyphs = {}
+            glyph = None
+            bitmap = None
+            with open(path, encoding="latin-1") as f:
+                for raw in f:
+                    fields = raw.split()
+                    if len(fields) == 0:
+                        continue
+                    keyword = fields[0]
+
+                    if bitmap != None:
+                        if keyword == "ENDCHAR":
+                            glyph['bitmap'] = _unpack(bitmap, glyph['width'])
+                            if glyph['encoding'] >= 0:
+                                self._glyphs[glyph['encoding']] = glyph
+                            glyph = None
+                            bitmap = None
+                        else:
+                            bitmap.append((int(keyword, 16), len(keyword) * 4))
+                    elif keyword == "FONTBOUNDINGBOX":
+                        self.height = int(fields[2])
+                        self.baseline = self.height + int(fields[4])
+                    elif keyword == "STARTCHAR":
+                        glyph = {'encoding': -1, 'advance': 0, 'width': 0, 'height': 0, 'x_offset': 0, 'y_offset': 0}
+                    elif glyph != None and keyword == "ENCODING":
+                        glyph['encoding'] = int(fields[1])
+                    elif glyph != None and keyword == "DWIDTH":
+                        glyph['advance'] = int(fields[1])
+                    elif glyph != None and keyword == "BBX":
+                        glyph['width'], glyph['height'], glyph['x_offset'], glyph['y_offset'] = [int(v) for v in fields[1:5]]
+                    elif glyph != None and keyword == "BITMAP":
+                        bitmap = []
+
+            if len(self._glyphs) == 0:
+                raise ValueError("No glyphs found in {}".format(path))
+
+        def CharacterWidth(self, char):
+            glyph = self._glyph(char)
+            return glyph['advance'] if glyph != None else 0
+
+        def _glyph(self, codepoint):
+            glyph = self._glyphs.get(codepoint)
+            if glyph == None:
+                # Same fallback as the real library, the unicode replacement character
+                glyph = self._glyphs.get(0xFFFD)
+            return glyph
+
+    @staticmethod
+    def DrawText(canvas, font, x, y, color, text):
+        canvas._count()
+        x = int(x)
+        y = int(y)
+        start = x
+        rgb = np.array((color.red, color.green, color.blue), dtype=np.uint8)
+        for char in text:
+            glyph = font._glyph(ord(char))
+            if glyph == None:
+                continue
+            bitmap = glyph['bitmap']
+            if bitmap.size > 0:
+                top = y - glyph['height'] - glyph['y_offset']
+                src = np.empty(bitmap.shape + (3,), dtype=np.uint8)
+                src[:] = rgb
+                canvas.blit(src, x + glyph['x_offset'], top, bitmap)
+            x += glyph['advance']
+        return x - start
+
+    @staticmethod
+    def DrawLine(canvas, x0, y0, x1, y1, color):
+        canvas._count()
+        x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+        rgb = (color.red, color.green, color.blue)
+        pixels = canvas.pixels
+
+        # Straight lines are most of what gets drawn, do those with one slice
+        if y0 == y1:
+            if 0 <= y0 < canvas.height:
+                left = max(0, min(x0, x1))
+                right = min(canvas.width - 1, max(x0, x1))
+                if left <= right:
+                    pixels[y0, left:right + 1] = rgb
+            return
+        if x0 == x1:
+            if 0 <= x0 < canvas.width:
+                top = max(0, min(y0, y1))
+                bottom = min(canvas.height - 1, max(y0, y1))
+                if top <= bottom:
+                    pixels[top:bottom + 1, x0] = rgb
+            return
+
+        # Bresenham for everything else
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        err = dx + dy
+        while True:
+            if 0 <= x0 < canvas.width and 0 <= y0 < canvas.height:
+                pixels[y0, x0] = rgb
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+
+graphics = _Graphics
+
+
+def _unpack(rows, width):
+    # BDF bitmap rows are hex, most significant bit is the leftmost pixel
+    bitmap = np.zeros((len(rows), width), dtype=bool)
+    for y, (value, bits) in enumerate(rows):
+        for x in range(min(width, bits)):
+            if value & (1 << (bits - 1 - x)):
+                bitmap[y, x] = True
+    return bitmap
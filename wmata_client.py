@@ -0,0 +1,125 @@
+# Shared HTTP client for the WMATA API
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import display_metrics
+
+log = logging.getLogger(__name__)
+
+# Point this at a local stand-in server to run without hitting WMATA.
+DEFAULT_BASE_URL = os.environ.get("WMATA_BASE_URL", "https://api.wmata.com")
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+MAX_RETRIES = 2
+BACKOFF_SECONDS = 0.5
+POOL_SIZE = 4
+
+PREDICTION_PATH = "/StationPrediction.svc/json/GetPrediction/"
+INCIDENTS_PATH = "/Incidents.svc/json/Incidents"
+
+# Status codes worth another try, everything else is returned as is.
+# 429 isn't one of them, trying again straight away only spends
+# more of a rate limit that's already used up.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def set_default_base_url(base_url):
+    # For this process only, e.g. a display reading through its own proxy
+    global DEFAULT_BASE_URL
+    DEFAULT_BASE_URL = base_url
+
+
+def get_client(api_key, base_url=None):
+    if base_url == None:
+        base_url = DEFAULT_BASE_URL
+    key = (api_key, base_url)
+    client = _clients.get(key)
+    if client == None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client == None:
+                client = WMATAClient(api_key, base_url)
+                _clients[key] = client
+    return client
+
+
+class WMATAClient:
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # A RequestBudget, if set, gets every attempt recorded and
+        # stops retries once it's used up
+        self.budget = None
+
+        # A single keep-alive session so every poll reuses the
+        # same TLS connection instead of handshaking again.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"api_key": api_key, "Accept": "application/json"})
+
+    def get_prediction(self, station_code):
+        return self.get(PREDICTION_PATH + station_code, "GetPrediction")
+
+    def get_incidents(self):
+        return self.get(INCIDENTS_PATH, "Incidents")
+
+    def get(self, path, endpoint):
+        attempt = 0
+        while True:
+            if self.budget != None:
+                self.budget.record()
+            try:
+                resp = self.session.get(self.base_url + path, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if not self.can_retry(attempt, endpoint):
+                    raise
+                log.warning("Request to {} failed, retrying.".format(endpoint))
+            else:
+                failed = resp.status_code in RETRY_STATUS_CODES
+                if not failed or not self.can_retry(attempt, endpoint):
+                    return resp
+                log.warning("{} returned {}, retrying.".format(endpoint, resp.status_code))
+
+            attempt += 1
+            display_metrics.inc("metro_wmata_retries_total", endpoint)
+            # Full jitter so a fleet of signs doesn't retry in lockstep
+            time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def can_retry(self, attempt, endpoint):
+        if attempt >= self.max_retries:
+            return False
+        if self.budget != None and self.budget.delay() > 0:
+            log.warning("Request budget used up, not retrying {}.".format(endpoint))
+            return False
+        return True
@@ -0,0 +1,176 @@
+# Serve WMATA responses to other signs from a short-lived cache
+# Copyright (C) 2020  Kenneth Schneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import json
+import logging
+import math
+import os
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from metrics import display_metrics
+from scheduler import RequestBudget
+from wmata_client import RETRY_STATUS_CODES, get_client
+
+log = logging.getLogger(__name__)
+
+# Set to 1 to answer GetPrediction and Incidents for other signs
+WMATA_PROXY = os.environ.get("WMATA_PROXY", "0") == "1"
+
+# How long a response is handed out before asking WMATA again.
+# Predictions only change every 20-30 seconds, incidents far less.
+PROXY_PREDICTION_TTL_SECONDS = float(os.environ.get("PROXY_PREDICTION_TTL_SECONDS", 10))
+PROXY_INCIDENT_TTL_SECONDS = float(os.environ.get("PROXY_INCIDENT_TTL_SECONDS", 60))
+
+# Failed fetches are kept too, for this long, so signs retrying
+# during an outage or a rate limit don't each start a new fetch
+PROXY_FAILURE_SECONDS = float(os.environ.get("PROXY_FAILURE_SECONDS", 5))
+
+# What gets handed back to a sign, straight from WMATA. expires_at
+# is filled in by the cache unless the fetch already knows it.
+CachedResponse = namedtuple('CachedResponse', ['status_code', 'body', 'fetched_at', 'expires_at'])
+
+
+class PendingFetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+class ProxyCache:
+    # Responses by key for ttl seconds, failures for failure_ttl.
+    # When several requests miss on the same key at once, the first
+    # one fetches and the rest wait for its answer.
+    def __init__(self, ttl, failure_ttl=PROXY_FAILURE_SECONDS):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        # Returns (response, how it was answered)
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry != None and now < entry.expires_at:
+                return entry, "hit"
+            pending = self._pending.get(key)
+            leader = pending == None
+            if leader:
+                pending = PendingFetch()
+                self._pending[key] = pending
+
+        if not leader:
+            pending.done.wait()
+            return pending.response, "coalesced"
+
+        response = None
+        try:
+            response = fetch()
+        finally:
+            if response == None:
+                response = CachedResponse(502, json.dumps({'error': "Could not reach WMATA"}).encode(), time.monotonic(), None)
+            if response.expires_at == None:
+                response = response._replace(expires_at=response.fetched_at + self.entry_ttl(response))
+            with self._lock:
+                del self._pending[key]
+                self._entries[key] = response
+                self._prune(response.fetched_at)
+            pending.response = response
+            pending.done.set()
+        return response, "miss"
+
+    def _prune(self, now):
+        # Keys are station codes so there aren't many, but signs
+        # that change station shouldn't leave entries behind forever
+        for key in [key for key, entry in self._entries.items() if now >= entry.expires_at]:
+            del self._entries[key]
+
+    def entry_ttl(self, response):
+        return self.ttl if response.status_code == 200 else self.failure_ttl
+
+    def retry_after(self, response, now):
+        # Seconds until a failed response stops being handed out
+        return max(1, int(math.ceil(response.expires_at - now)))
+
+
+class WMATAProxy:
+    def __init__(self, api_key,
+                 prediction_ttl=PROXY_PREDICTION_TTL_SECONDS,
+                 incident_ttl=PROXY_INCIDENT_TTL_SECONDS):
+        self.api_key = api_key
+        self.predictions = ProxyCache(prediction_ttl)
+        self.incidents = ProxyCache(incident_ttl)
+        # Every request to WMATA for every sign, this sign's own
+        # display included, comes out of this one budget
+        self.budget = RequestBudget(name="proxy")
+        get_client(api_key).budget = self.budget
+
+    def get_prediction(self, station_codes):
+        # "A01,C01" and "c01,A01" are the same request
+        codes = sorted(set(code.strip().upper() for code in station_codes.split(',') if code.strip() != ''))
+        key = ",".join(codes)
+        return self._answer(self.predictions, key, lambda: get_client(self.api_key).get_prediction(key), "GetPrediction")
+
+    def get_incidents(self):
+        return self._answer(self.incidents, "Incidents", lambda: get_client(self.api_key).get_incidents(), "Incidents")
+
+    def _answer(self, cache, key, request_upstream, endpoint):
+        def fetch():
+            # Out of budget: don't ask WMATA, tell the sign when to come back
+            wait = self.budget.delay()
+            if wait > 0:
+                log.warning("Request budget used up, not fetching {} {} for {:.0f}s".format(endpoint, key, wait))
+                now = time.monotonic()
+                used_up = {
+                    'error': "Request budget used up"
+                }
+                return CachedResponse(429, json.dumps(used_up).encode(), now, now + wait)
+            try:
+                resp = request_upstream()
+            except Exception:
+                log.error("Proxy request for {} {} failed".format(endpoint, key))
+                log.error(traceback.format_exc())
+                return None
+            if resp.status_code != 200:
+                log.error("Proxy request for {} {} returned {}".format(endpoint, key, resp.status_code))
+            return CachedResponse(resp.status_code, resp.content, time.monotonic(), None)
+
+        response, result = cache.get(key, fetch)
+        display_metrics.inc("metro_proxy_requests_total", result)
+        log.debug("Proxy {} {}: {}".format(endpoint, key, result))
+        return self.for_peer(cache, response)
+
+    def for_peer(self, cache, response):
+        # (body, status, headers) to send back. Failures say when the
+        # proxy will ask WMATA again. The signs' clients retry a 5xx
+        # straight away and would only get the same cached failure,
+        # so those go back as a 429, which they don't retry.
+        now = time.monotonic()
+        headers = {'Content-Type': 'application/json', 'Age': str(max(0, int(now - response.fetched_at)))}
+        if response.status_code == 200:
+            return response.body, 200, headers
+
+        headers['Retry-After'] = str(cache.retry_after(response, now))
+        if response.status_code not in RETRY_STATUS_CODES:
+            return response.body, response.status_code, headers
+        failed = {
+            'error': "Could not get an answer from WMATA ({})".format(response.status_code)
+        }
+        return json.dumps(failed).encode(), 429, headers